@@ -0,0 +1,463 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Collection, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from kbs_cache import canonicalize_config
+from kbs_runners import BuildRunner
+from kbs_preflight import (
+    Preflight,
+    PreflightError,
+    PreflightUnavailable,
+    UnknownRevision,
+)
+
+logger = logging.getLogger()
+
+MAX_CONFIG_SIZE = 1 * 2**20
+MAX_HEADER_SIZE = 16 * 2**10
+
+# Both end up on kbs_builder's command line, and the project in paths, so they are kept plain
+PROJECT_PATTERN = re.compile(r"[a-z0-9][a-z0-9_-]{0,63}")
+VERSION_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._+/-]{0,127}")
+
+
+class BadRequest(Exception):
+    """A request the service won't take, however often it is retried"""
+
+
+class ServiceBusy(Exception):
+    """A request the service can't take on right now, which the client should retry"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ClientLimit(ServiceBusy):
+    """The client has as many builds in flight as it is allowed"""
+
+
+@dataclass
+class ServiceJob(object):
+    """A build, which moves from queued to running, then to done or failed"""
+
+    job_id: str
+    key: str
+    project: str
+    version: str
+    work_dir: Path
+    # The client the job is counted against, which is the first to ask for the build
+    client: str
+    state: str = "queued"
+    exit_status: Optional[int] = None
+    created: float = field(default_factory=time.time)
+    # Everything that has happened to the job, which status streams replay then follow
+    events: List[dict] = field(default_factory=list)
+    # Requests for the same build that were coalesced into this job
+    joined: int = 0
+    # What the preflight check found, if there was one
+    preflight: Optional[dict] = None
+    _changed: asyncio.Condition = field(default_factory=asyncio.Condition, repr=False)
+
+    @property
+    def inbox(self) -> Path:
+        return self.work_dir / "inbox"
+
+    @property
+    def outbox(self) -> Path:
+        return self.work_dir / "outbox"
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("done", "failed")
+
+    async def add_event(self, event: dict):
+        async with self._changed:
+            self.events.append({"time": round(time.time(), 3), **event})
+            self._changed.notify_all()
+
+    async def set_state(self, state: str):
+        self.state = state
+        await self.add_event({"state": state})
+
+    async def follow(self):
+        """Yields every event, including those still to come, until the job is finished"""
+        sent = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: len(self.events) > sent or self.finished
+                )
+                new_events = self.events[sent:]
+                finished = self.finished
+            for event in new_events:
+                yield event
+            sent += len(new_events)
+            if finished and sent == len(self.events):
+                return
+
+    def status(self) -> dict:
+        status = {
+            "id": self.job_id,
+            "project": self.project,
+            "version": self.version,
+            "state": self.state,
+            "created": self.created,
+            "joined": self.joined,
+        }
+        if self.preflight:
+            status["preflight"] = self.preflight
+        if self.finished:
+            status["exit_status"] = self.exit_status
+            status["results"] = sorted(
+                path.name for path in self.outbox.iterdir() if path.is_file()
+            )
+        return status
+
+
+class BuildService(object):
+    """
+    Runs build requests, a few at a time, coalescing identical ones
+
+    Requests for the same project, version and config (after canonicalize_config) as one that is
+    queued or running join that job, rather than building again. Each client can only have so many
+    jobs queued or running at once, and the service as a whole only queues so many, past which
+    requests are turned away with a time to retry after. Finished jobs are kept, with their results,
+    until they are among the oldest past max_finished.
+
+    With a preflight, configs are checked against the revision's Kconfig before they are queued,
+    and the build gets the config as olddefconfig leaves it. Requests are then coalesced by the
+    commit and the minimal config, so configs that only differ in spelling out defaults, or in the
+    version name of the same commit, share a build.
+    """
+
+    def __init__(
+        self,
+        runner: BuildRunner,
+        work_root: Path,
+        builds: int = 1,
+        per_client: int = 2,
+        max_queued: int = 32,
+        max_finished: int = 256,
+        preflight: Optional[Preflight] = None,
+        projects: Optional[Collection[str]] = None,
+    ):
+        self.runner = runner
+        self.preflight = preflight
+        # Only these projects are built, when given, rather than any the runner might find
+        self.projects = projects
+        self.work_root = work_root
+        self.per_client = per_client
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.jobs: Dict[str, ServiceJob] = {}
+        self._in_flight: Dict[str, ServiceJob] = {}
+        self._finished: OrderedDict[str, ServiceJob] = OrderedDict()
+        self._build_slots = asyncio.Semaphore(builds)
+        # The loop only keeps weak references to tasks
+        self._tasks = set()
+        work_root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key_for(project: str, version: str, config: bytes) -> str:
+        canonical = canonicalize_config(config.decode(errors="replace"))
+        return hashlib.sha256(
+            json.dumps([project, version, canonical]).encode()
+        ).hexdigest()
+
+    def _retry_after(self) -> int:
+        # Roughly when a build will have finished, going by the ones so far
+        durations = [
+            job.events[-1]["time"] - job.created for job in self._finished.values()
+        ]
+        return max(1, round(sum(durations) / len(durations))) if durations else 30
+
+    def validate(self, project: str, version: str):
+        if not PROJECT_PATTERN.fullmatch(project):
+            raise BadRequest(f"Invalid project name {project!r}")
+        if self.projects is not None and project not in self.projects:
+            raise BadRequest(f"Unknown project {project}")
+        # The preflight can only check projects the revdb has
+        if self.preflight and project not in self.preflight.projects():
+            raise BadRequest(f"Unknown project {project}")
+        if not VERSION_PATTERN.fullmatch(version) or ".." in version:
+            raise BadRequest(f"Invalid version {version!r}")
+
+    async def submit(
+        self, client: str, project: str, version: str, config: bytes
+    ) -> Tuple[ServiceJob, bool]:
+        """Returns the job for the build, and whether it was already in flight"""
+        self.validate(project, version)
+        preflight = None
+        if self.preflight:
+            # kconfiglib blocks, if only for milliseconds once the revision's Kconfig is parsed
+            result = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.preflight.check,
+                project,
+                version,
+                config.decode(errors="replace"),
+            )
+            key = self.key_for(project, result.git_sha, result.min_config.encode())
+            config = result.config.encode()
+            preflight = {
+                "git_sha": result.git_sha,
+                "kconfig_hash": result.kconfig_hash,
+                "dropped": result.dropped,
+                "changed": result.changed,
+                "seconds": result.seconds,
+            }
+        else:
+            key = self.key_for(project, version, config)
+        job = self._in_flight.get(key)
+        if job:
+            # Joining costs nothing, so isn't counted against the client
+            job.joined += 1
+            return job, True
+
+        client_jobs = sum(1 for job in self._in_flight.values() if job.client == client)
+        if client_jobs >= self.per_client:
+            raise ClientLimit(
+                f"{client} already has {client_jobs} builds in flight",
+                self._retry_after(),
+            )
+        queued = sum(1 for job in self._in_flight.values() if job.state == "queued")
+        if queued >= self.max_queued:
+            raise ServiceBusy(f"{queued} builds already queued", self._retry_after())
+
+        job_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        job = ServiceJob(
+            job_id,
+            key,
+            project,
+            version,
+            self.work_root / job_id,
+            client,
+            preflight=preflight,
+        )
+        job.inbox.mkdir(parents=True)
+        job.outbox.mkdir()
+        (job.inbox / "Kconfig").write_bytes(config)
+        job.events.append({"time": round(job.created, 3), "state": job.state})
+        self.jobs[job_id] = job
+        self._in_flight[key] = job
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        logger.info(f"Queued {job_id}: {project} {version} for {client}")
+        return job, False
+
+    async def _run(self, job: ServiceJob):
+        try:
+            async with self._build_slots:
+                await job.set_state("running")
+                job.exit_status = await self.runner.run(
+                    job.project,
+                    job.version,
+                    job.inbox,
+                    job.outbox,
+                    lambda line: job.add_event({"log": line}),
+                )
+            succeeded = job.exit_status == 0 and (job.outbox / "result.zip").exists()
+        except Exception as e:
+            logger.exception(f"Running {job.job_id} failed")
+            await job.add_event({"log": f"Runner failed: {e}"})
+            succeeded = False
+        finally:
+            # Later requests for this build start a new one, which may well hit the result cache
+            del self._in_flight[job.key]
+        await job.set_state("done" if succeeded else "failed")
+        logger.info(f"Finished {job.job_id}: {job.state}")
+        self._finished[job.job_id] = job
+        while len(self._finished) > self.max_finished:
+            _, old_job = self._finished.popitem(last=False)
+            del self.jobs[old_job.job_id]
+            shutil.rmtree(old_job.work_dir, ignore_errors=True)
+
+
+class HTTPError(Exception):
+    def __init__(
+        self, status: int, message: str, headers: Optional[Dict[str, str]] = None
+    ):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Content",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class BuildAPI(object):
+    """
+    A minimal HTTP/1.1 front end to a BuildService, one request per connection
+
+    POST /builds?project=P&version=V   the config as the body, replies 202 with the job's status
+    GET /builds/ID                     the job's status
+    GET /builds/ID/events              the job's events so far, then as they happen, as JSON lines
+    GET /builds/ID/FILE                one of the job's results, once it is finished
+    """
+
+    def __init__(self, service: BuildService):
+        self.service = service
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(
+            self.handle, host, port, limit=MAX_HEADER_SIZE
+        )
+        logger.info(f"Listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = writer.get_extra_info("peername")[0]
+        try:
+            method, target, headers = await self.read_head(reader)
+            body = b""
+            if "content-length" in headers:
+                length = int(headers["content-length"])
+                if length > MAX_CONFIG_SIZE:
+                    raise HTTPError(413, "Config too large")
+                body = await reader.readexactly(length)
+            await self.route(client, method, target, body, writer)
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {"error": str(e)}, e.headers)
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            await self.send_json(writer, 400, {"error": "Malformed request"})
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception(f"Request from {client} failed")
+            try:
+                await self.send_json(writer, 500, {"error": "Internal error"})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_head(reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("Bad request line")
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return request_line[0], request_line[1], headers
+
+    async def route(self, client, method, target, body, writer):
+        url = urlsplit(target)
+        parts = [part for part in url.path.split("/") if part]
+        if parts == ["builds"]:
+            if method != "POST":
+                raise HTTPError(405, "Builds are requested with POST")
+            query = parse_qs(url.query)
+            if "project" not in query or "version" not in query or not body:
+                raise HTTPError(400, "project, version, and a config are required")
+            try:
+                job, coalesced = await self.service.submit(
+                    client, query["project"][0], query["version"][0], body
+                )
+            except (BadRequest, UnknownRevision) as e:
+                raise HTTPError(400, str(e))
+            except PreflightUnavailable as e:
+                raise HTTPError(500, str(e))
+            except PreflightError as e:
+                await self.send_json(
+                    writer, 422, {"error": str(e), "problems": e.problems}
+                )
+                return
+            except ServiceBusy as e:
+                raise HTTPError(
+                    429 if isinstance(e, ClientLimit) else 503,
+                    str(e),
+                    {"Retry-After": str(e.retry_after)},
+                )
+            await self.send_json(
+                writer,
+                202,
+                {**job.status(), "coalesced": coalesced},
+                {"Location": f"/builds/{job.job_id}"},
+            )
+            return
+
+        if len(parts) < 2 or parts[0] != "builds" or parts[1] not in self.service.jobs:
+            raise HTTPError(404, "No such build")
+        if method != "GET":
+            raise HTTPError(405, "Only GET is supported here")
+        job = self.service.jobs[parts[1]]
+        if len(parts) == 2:
+            await self.send_json(writer, 200, job.status())
+        elif parts[2:] == ["events"]:
+            await self.send_events(writer, job)
+        elif len(parts) == 3 and job.finished and (job.outbox / parts[2]).is_file():
+            await self.send_file(writer, job.outbox / parts[2])
+        else:
+            raise HTTPError(404, "No such result")
+
+    @staticmethod
+    def head(status: int, headers: Dict[str, str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send_json(
+        self, writer, status: int, body: dict, headers: Optional[Dict[str, str]] = None
+    ):
+        data = json.dumps(body).encode() + b"\n"
+        writer.write(
+            self.head(
+                status,
+                {
+                    "Content-Type": "application/json",
+                    "Content-Length": str(len(data)),
+                    **(headers or {}),
+                },
+            )
+        )
+        writer.write(data)
+        await writer.drain()
+
+    async def send_events(self, writer, job: ServiceJob):
+        # Without a length, the stream runs until the connection closes, when the job is finished
+        writer.write(self.head(200, {"Content-Type": "application/x-ndjson"}))
+        async for event in job.follow():
+            writer.write(json.dumps(event).encode() + b"\n")
+            # Waiting on a slow client here keeps a job's log from piling up in memory twice over
+            await writer.drain()
+
+    async def send_file(self, writer, path: Path):
+        writer.write(
+            self.head(
+                200,
+                {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(path.stat().st_size),
+                },
+            )
+        )
+        with path.open("rb") as result_file:
+            while chunk := result_file.read(2**16):
+                writer.write(chunk)
+                await writer.drain()
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from kbs_build import BuildJob, BuildResources, SharedTree, check_out, run_build
+
+logger = logging.getLogger()
+
+
+def find_configs(config_dir: Path) -> Dict[str, Path]:
+    """The configs in a batch directory, by the name their results go under"""
+    configs = {}
+    for config_path in sorted(config_dir.iterdir()):
+        if not config_path.is_file() or config_path.name.startswith("."):
+            continue
+        if config_path.stem in configs:
+            raise ValueError(
+                f"{config_path.name} and {configs[config_path.stem].name} would share results"
+            )
+        configs[config_path.stem] = config_path
+    return configs
+
+
+def make_jobs_per_build(builds: int, make_jobs: Optional[int]) -> int:
+    """Split make's jobs between the builds running at once, so they don't oversubscribe the CPUs"""
+    return max(1, (make_jobs or os.cpu_count() or 1) // builds)
+
+
+def slot_out_name(slot: int) -> str:
+    # Each concurrent build has an output directory to itself. These are reused from build to build
+    # rather than named per config, so that compiler command lines, which ccache keys on, repeat
+    # from batch to batch. The first is Klipper's usual one, which single builds use too.
+    return "out" if slot == 0 else f"out-{slot}"
+
+
+def run_batch(
+    project: str,
+    version: str,
+    configs: Dict[str, Path],
+    outbox: Path,
+    scratch_root: Path,
+    jobs: int,
+    resources: BuildResources = BuildResources(),
+    make_jobs: Optional[int] = None,
+) -> dict:
+    """
+    Build several configs of one version from a single checkout, several at once
+
+    Each config's results go in outbox/<name>/, as a single build's would in the outbox, and the
+    batch's timings and outcomes are written to outbox/batch-report.json, which is returned.
+    """
+    jobs = max(1, min(jobs, len(configs)))
+    build_make_jobs = make_jobs_per_build(jobs, make_jobs)
+    report = {
+        "project": project,
+        "version": version,
+        "jobs": jobs,
+        "make_jobs": build_make_jobs,
+        "timings": {},
+        "builds": {},
+    }
+    batch_start = time.monotonic()
+
+    # Each batch gets a scratch directory to itself, as worker jobs do, so nothing is left over
+    # for the next one to check out on top of
+    scratch_root.mkdir(parents=True, exist_ok=True)
+    work_dir = Path(tempfile.mkdtemp(prefix="batch-", dir=scratch_root))
+    try:
+        logger.info(f"Checking out repo for a batch of {len(configs)}")
+        checkout_start = time.monotonic()
+        git_sha = None
+        checkout_error = None
+        try:
+            git_sha = check_out(project, version, work_dir, resources)
+        except Exception as e:
+            logger.exception("Checkout for the batch failed")
+            checkout_error = e
+        report["timings"]["checkout"] = round(time.monotonic() - checkout_start, 3)
+        if checkout_error:
+            report["checkout_error"] = str(checkout_error)
+            for name in configs:
+                report["builds"][name] = {
+                    "succeeded": False,
+                    "error": "Checkout failed",
+                    "timings": {},
+                }
+        else:
+            if git_sha:
+                report["git_sha"] = git_sha
+            report["builds"] = build_configs(
+                project,
+                version,
+                configs,
+                outbox,
+                work_dir,
+                git_sha,
+                jobs,
+                resources,
+                build_make_jobs,
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report["timings"]["total"] = round(time.monotonic() - batch_start, 3)
+    report["timings"].update(sum_build_timings(list(report["builds"].values())))
+    report["succeeded"] = sum(b["succeeded"] for b in report["builds"].values())
+    report["failed"] = len(configs) - report["succeeded"]
+
+    outbox.mkdir(parents=True, exist_ok=True)
+    with (outbox / "batch-report.json").open("w+") as report_file:
+        json.dump(report, report_file, indent=2)
+    logger.info(
+        f"Batch done in {report['timings']['total']}s: "
+        f"{report['succeeded']} succeeded, {report['failed']} failed"
+    )
+    return report
+
+
+def build_configs(
+    project: str,
+    version: str,
+    configs: Dict[str, Path],
+    outbox: Path,
+    work_dir: Path,
+    git_sha: Optional[str],
+    jobs: int,
+    resources: BuildResources,
+    make_jobs: int,
+) -> Dict[str, dict]:
+    """Build each config in the tree checked out at work_dir/srctree, returning their outcomes"""
+    free_slots = queue.SimpleQueue()
+    for slot in range(jobs):
+        free_slots.put(slot)
+
+    def build_config(name: str, config_path: Path) -> dict:
+        build_outbox = outbox / name
+        build_outbox.mkdir(parents=True, exist_ok=True)
+        build_work_dir = work_dir / "builds" / name
+        build_work_dir.mkdir(parents=True, exist_ok=True)
+        job = BuildJob(
+            project,
+            version,
+            config_path,
+            build_outbox,
+            work_dir=build_work_dir,
+            make_jobs=make_jobs,
+        )
+        slot = free_slots.get()
+        try:
+            shared_tree = SharedTree(work_dir / "srctree", git_sha, slot_out_name(slot))
+            run_build(job, resources, shared_tree)
+            outcome = {"succeeded": True}
+        except Exception as e:
+            logger.exception(f"Build of {name} failed")
+            outcome = {"succeeded": False, "error": str(e)}
+        finally:
+            free_slots.put(slot)
+        outcome["timings"] = job.timings
+        breakdown = " ".join(f"{k}={v}s" for k, v in job.timings.items())
+        logger.info(
+            f"{name} {'succeeded' if outcome['succeeded'] else 'failed'}: {breakdown}"
+        )
+        return outcome
+
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = {
+            name: pool.submit(build_config, name, config_path)
+            for name, config_path in configs.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def sum_build_timings(outcomes: List[dict]) -> Dict[str, float]:
+    """The time all the builds spent in each phase, which is more than the batch took, when they overlap"""
+    totals = {}
+    for outcome in outcomes:
+        for phase, seconds in outcome["timings"].items():
+            totals[f"builds_{phase}"] = round(
+                totals.get(f"builds_{phase}", 0) + seconds, 3
+            )
+    return totals
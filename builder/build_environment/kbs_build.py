@@ -0,0 +1,283 @@
+import json
+import logging
+import shutil
+import sys
+import time
+import zipfile
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, run
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from kbs_cache import ResultCache, canonicalize_config, resolve_revision
+from kbs_ccache import CompileCache
+from kbs_trees import TreePool
+
+logger = logging.getLogger()
+
+GITREF = Path("/media/git")
+
+# Deflate level for each type of file in result.zip. Firmware images barely compress, so they get
+# the least effort, and the text formats (and the ELF's debug info) the most.
+PACKAGE_COMPRESSION = {
+    ".bin": 1,
+    ".uf2": 1,
+    ".elf": 6,
+    ".hex": 9,
+    ".dict": 9,
+    ".json": 9,
+    ".log": 9,
+}
+DEFAULT_COMPRESSION = 6
+
+# Klipper's Makefile prints this as it starts linking, which is when compiling is over
+LINK_MARKER = b"  Linking "
+
+
+@dataclass
+class BuildJob(object):
+    project: str
+    version: str
+    config_path: Path
+    outbox: Path
+    # Scratch directory the source tree is checked out into
+    work_dir: Path = Path(".")
+    # Seconds spent in each phase, reported in build-meta.json
+    timings: Dict[str, float] = field(default_factory=dict)
+    # make's -j, or as many as make likes when None
+    make_jobs: Optional[int] = None
+    # build.log, which everything run for the build writes to, as it runs
+    log: Optional[BinaryIO] = field(default=None, repr=False)
+    started: float = field(default_factory=time.monotonic, repr=False)
+    _phase: Optional[Tuple[str, float]] = field(default=None, init=False, repr=False)
+
+    @contextmanager
+    def phase(self, name: str):
+        self.start_phase(name)
+        try:
+            yield
+        finally:
+            self.end_phase()
+
+    @property
+    def current_phase(self) -> Optional[str]:
+        return self._phase[0] if self._phase else None
+
+    def start_phase(self, name: str):
+        """Start timing a phase, ending the current one, if there is one"""
+        if self._phase:
+            self.end_phase()
+        self._phase = (name, time.monotonic())
+        self.log_line(f"=== {name} ===".encode())
+
+    def end_phase(self):
+        name, start = self._phase
+        self._phase = None
+        self.timings[name] = round(time.monotonic() - start, 3)
+        self.log_line(f"=== {name} took {self.timings[name]}s ===".encode())
+
+    def log_line(self, line: bytes):
+        if self.log:
+            # Stamped with the time since the job started
+            self.log.write(
+                b"[%9.3f] %s\n" % (time.monotonic() - self.started, line.rstrip(b"\n"))
+            )
+
+    def run_logged(
+        self,
+        args: List[str],
+        on_line: Optional[Callable[[bytes], None]] = None,
+        **kwargs,
+    ):
+        """Run a command, streaming its output into the build log and to stdout"""
+        with Popen(args, stdout=PIPE, stderr=STDOUT, **kwargs) as process:
+            for line in process.stdout:
+                sys.stdout.buffer.write(line)
+                self.log_line(line)
+                if on_line:
+                    on_line(line)
+        sys.stdout.flush()
+        if process.returncode:
+            raise CalledProcessError(process.returncode, args)
+
+
+@dataclass
+class BuildResources(object):
+    """Caches and pools shared between builds, any of which may be left out"""
+
+    result_cache: Optional[ResultCache] = None
+    tree_pool: Optional[TreePool] = None
+    compile_cache: Optional[CompileCache] = None
+
+
+@dataclass
+class SharedTree(object):
+    """A checkout that several builds use at once, each with its own output directory"""
+
+    src_tree: Path
+    git_sha: Optional[str]
+    # Relative to the tree, like Klipper's own "out"
+    out_name: str
+
+
+def should_package_file(path: Path) -> bool:
+    if path.stem == "klipper":
+        logger.info(f"Archiving {path.name}")
+        return True
+    return False
+
+
+def write_build_meta(outbox: Path, build_meta: dict) -> None:
+    with (outbox / "build-meta.json").open("w+") as build_meta_file:
+        json.dump(build_meta, build_meta_file, indent=2)
+
+
+def check_out(
+    project: str,
+    version: str,
+    work_dir: Path,
+    resources: BuildResources,
+    job: Optional[BuildJob] = None,
+) -> Optional[str]:
+    """Check the version out at work_dir/srctree, returning the commit if it was resolved"""
+    if resources.tree_pool:
+        return resources.tree_pool.lease(project, version, work_dir / "srctree")
+    if job:
+        job.run_logged(["get-srctree", project, version], cwd=work_dir)
+    else:
+        run(["get-srctree", project, version], cwd=work_dir, check=True)
+    return None
+
+
+def package_files(output_zip: zipfile.ZipFile, files: List[Path]) -> None:
+    for path in files:
+        # ZipFile.write copies in chunks, so large ELFs aren't read into memory
+        output_zip.write(
+            path,
+            path.name,
+            compress_type=zipfile.ZIP_DEFLATED,
+            compresslevel=PACKAGE_COMPRESSION.get(path.suffix, DEFAULT_COMPRESSION),
+        )
+
+
+def run_build(
+    job: BuildJob,
+    resources: BuildResources = BuildResources(),
+    shared_tree: Optional[SharedTree] = None,
+) -> dict:
+    """Build a single config, leaving the results in the job's outbox, and returning the build metadata
+
+    With a shared tree, the build uses that checkout instead of its own, and builds into the tree's
+    output directory, leaving the .config there as well.
+    """
+    # Unbuffered, so that the log can be followed while the build runs
+    job.log = (job.outbox / "build.log").open("wb", buffering=0)
+    try:
+        return _run_build(job, resources, shared_tree)
+    except Exception as e:
+        job.log_line(f"Build failed: {e}".encode())
+        raise
+    finally:
+        job.log.close()
+        job.log = None
+
+
+def _run_build(
+    job: BuildJob, resources: BuildResources, shared_tree: Optional[SharedTree]
+) -> dict:
+    result_cache = resources.result_cache
+    build_meta = {"project": job.project, "version": job.version}
+
+    if not job.config_path.exists():
+        raise ValueError("Configuration not present, reufsing to build")
+
+    if result_cache:
+        with job.phase("cache_lookup"):
+            git_sha = resolve_revision(GITREF, job.project, job.version)
+            build_meta["git_sha"] = git_sha
+            cache_key = ResultCache.key_for(
+                job.project, git_sha, canonicalize_config(job.config_path.read_text())
+            )
+            cached_meta, cache_stats = result_cache.fetch(cache_key, job.outbox)
+        if cached_meta is not None:
+            logger.info(f"Reusing cached build {cache_key}")
+            job.log_line(f"Reusing cached build {cache_key}".encode())
+            cached_meta["cache"] = cache_stats
+            cached_meta["timings"] = job.timings
+            write_build_meta(job.outbox, cached_meta)
+            return cached_meta
+        build_meta["cache"] = cache_stats
+
+    make_args: List[str] = [f"-j{job.make_jobs}" if job.make_jobs else "-j"]
+    if shared_tree:
+        src_tree = shared_tree.src_tree
+        out_dir = src_tree / shared_tree.out_name
+        config_path = out_dir / ".config"
+        if shared_tree.git_sha:
+            build_meta["git_sha"] = shared_tree.git_sha
+        # Klipper's Makefile lets both of these be set from the command line
+        make_args += [
+            f"OUT={shared_tree.out_name}/",
+            f"KCONFIG_CONFIG={config_path.resolve()}",
+        ]
+    else:
+        src_tree = job.work_dir / "srctree"
+        out_dir = src_tree / "out"
+        config_path = src_tree / ".config"
+
+        logger.info("Checking out repo")
+        with job.phase("checkout"):
+            git_sha = check_out(job.project, job.version, job.work_dir, resources, job)
+            if git_sha:
+                build_meta["git_sha"] = git_sha
+
+    with job.phase("configure"):
+        if shared_tree:
+            # Left over from the last build in this output directory
+            shutil.rmtree(out_dir, ignore_errors=True)
+            out_dir.mkdir()
+        shutil.copy(job.config_path, config_path)
+
+    def on_make_line(line: bytes):
+        # A single make run does both, so the link phase starts when make says so
+        if line.startswith(LINK_MARKER) and job.current_phase == "compile":
+            job.start_phase("link")
+
+    with job.phase("compile"):
+        if resources.compile_cache:
+            job.run_logged(
+                ["make", *make_args, *resources.compile_cache.make_args()],
+                on_make_line,
+                cwd=src_tree,
+                env=resources.compile_cache.env(src_tree, job.work_dir),
+            )
+            build_meta["compile_cache"] = resources.compile_cache.collect(job.work_dir)
+        else:
+            job.run_logged(["make", *make_args], on_make_line, cwd=src_tree)
+
+    result_zip = job.outbox / "result.zip"
+    with job.phase("package"):
+        with zipfile.ZipFile(result_zip, "x") as output_zip:
+            package_files(
+                output_zip, list(filter(should_package_file, out_dir.iterdir()))
+            )
+
+    # Added once the build is over, so that they cover all of it
+    build_meta["timings"] = job.timings
+    job.log_line(b"Build complete")
+    with zipfile.ZipFile(result_zip, "a") as output_zip:
+        output_zip.writestr(
+            "build-meta.json",
+            json.dumps(build_meta, indent=2),
+            compress_type=zipfile.ZIP_DEFLATED,
+            compresslevel=PACKAGE_COMPRESSION[".json"],
+        )
+        package_files(output_zip, [job.outbox / "build.log"])
+
+    write_build_meta(job.outbox, build_meta)
+
+    if result_cache:
+        result_cache.store(cache_key, job.outbox)
+
+    return build_meta
@@ -0,0 +1,189 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+logger = logging.getLogger()
+
+# Files which make up a finished build in the outbox, and so in a cache entry
+RESULT_FILES = ("result.zip", "build-meta.json")
+
+
+def resolve_revision(git_dir: Path, project: str, revish: str) -> str:
+    """Resolve a ref-ish to a full commit SHA, using the gitref's project-prefixed refs"""
+    candidates = [
+        f"refs/tags/{project}/{revish}",
+        f"refs/heads/{project}/{revish}",
+        revish,
+    ]
+    for candidate in candidates:
+        result = subprocess.run(
+            [
+                "git",
+                "--git-dir",
+                str(git_dir),
+                "rev-parse",
+                "--verify",
+                "--quiet",
+                f"{candidate}^{{commit}}",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode == 0:
+            return result.stdout.strip()
+    raise ValueError(f"Could not resolve {revish} for {project}")
+
+
+def gitref_projects(git_dir: Path) -> Set[str]:
+    """The projects the gitref has branches of, from the prefix make-gitref gives their refs"""
+    refs = subprocess.run(
+        [
+            "git",
+            "--git-dir",
+            str(git_dir),
+            "for-each-ref",
+            "--format=%(refname:lstrip=2)",
+            "refs/heads/",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {ref.split("/", 1)[0] for ref in refs.stdout.splitlines() if "/" in ref}
+
+
+def canonicalize_config(config_text: str) -> str:
+    """
+    Produce a stable form of a .config, so that equivalent configs share a cache key
+
+    Comments are stripped, except for "is not set" markers which are turned into their =n form,
+    since kconfig treats those as assignments. When a symbol is assigned multiple times, the last
+    assignment wins (as it does in kconfig). The result is sorted by symbol name.
+    Defaulted symbols can't be detected without the revision's Kconfig tree, so configs which spell
+    out defaults will key separately.
+    """
+    assignments: Dict[str, str] = {}
+    for line in config_text.splitlines():
+        line = line.strip()
+        if line.startswith("# CONFIG_") and line.endswith(" is not set"):
+            assignments[line[2:].split(" ", 1)[0]] = "n"
+            continue
+        if not line or line.startswith("#"):
+            continue
+        name, sep, value = line.partition("=")
+        if not sep:
+            raise ValueError(f"Malformed config line: {line}")
+        assignments[name.strip()] = value.strip()
+    return "".join(f"{k}={assignments[k]}\n" for k in sorted(assignments))
+
+
+class ResultCache(object):
+    """
+    A content-addressed store of finished builds, keyed on (project, commit, canonical config)
+
+    Entries are directories holding the outbox files of a build. The mtime of each entry directory
+    is bumped when it is used, and is what eviction uses to find the least recently used entries.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.entries_dir = cache_dir / "results"
+        self.stats_path = cache_dir / "stats.json"
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key_for(project: str, git_sha: str, canonical_config: str) -> str:
+        key_hash = hashlib.sha256()
+        for part in (project, git_sha, canonical_config):
+            key_hash.update(part.encode())
+            key_hash.update(b"\0")
+        return key_hash.hexdigest()
+
+    @contextmanager
+    def _locked(self):
+        with (self.cache_dir / ".lock").open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _entry_path(self, key: str) -> Path:
+        return self.entries_dir / key
+
+    def _bump_stat(self, name: str) -> Dict[str, int]:
+        # Caller must hold the lock
+        try:
+            stats = json.loads(self.stats_path.read_text())
+        except (FileNotFoundError, ValueError):
+            stats = {}
+        stats[name] = stats.get(name, 0) + 1
+        self.stats_path.write_text(json.dumps(stats))
+        return stats
+
+    def fetch(self, key: str, outbox: Path) -> Tuple[Optional[dict], dict]:
+        """
+        Copy a cached result into the outbox
+
+        Returns the cached build metadata (or None on a miss), and a summary of the cache's counters
+        for inclusion in build-meta.json
+        """
+        entry = self._entry_path(key)
+        with self._locked():
+            if not entry.is_dir():
+                return None, self._summary(key, False, self._bump_stat("misses"))
+            os.utime(entry)
+            for name in RESULT_FILES:
+                shutil.copyfile(entry / name, outbox / name)
+            summary = self._summary(key, True, self._bump_stat("hits"))
+        return json.loads((outbox / "build-meta.json").read_text()), summary
+
+    def store(self, key: str, outbox: Path) -> None:
+        """Add the result of a build in the outbox to the cache, then evict down to size"""
+        entry = self._entry_path(key)
+        staging = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.entries_dir))
+        for name in RESULT_FILES:
+            shutil.copyfile(outbox / name, staging / name)
+        with self._locked():
+            if entry.exists():
+                # Someone else built the same thing while we were working
+                shutil.rmtree(staging)
+            else:
+                staging.rename(entry)
+            self._evict()
+
+    def _evict(self) -> None:
+        # Caller must hold the lock
+        entries = []
+        total_size = 0
+        for entry in self.entries_dir.iterdir():
+            if entry.name.startswith("."):
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+            total_size += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            logger.info(f"Evicting cached build {entry.name}")
+            shutil.rmtree(entry)
+            total_size -= size
+
+    @staticmethod
+    def _summary(key: str, hit: bool, stats: Dict[str, int]) -> dict:
+        return {
+            "key": key,
+            "hit": hit,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+        }
@@ -0,0 +1,105 @@
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger()
+
+# ccache stats log counters that mean a compile was served from the cache, or had to be run
+HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit")
+MISS_COUNTERS = ("cache_miss",)
+
+
+class CompileCache(object):
+    """
+    An object-level compile cache shared between builds, backed by ccache
+
+    ccache keys objects on the compiler, the flags, and the preprocessed source (which takes in
+    autoconf.h), so configs for the same MCU share most objects even when their .configs differ.
+    ccache is wrapped around the compiler through make's command line, so the Makefile's
+    per-architecture CROSS_PREFIX still picks the toolchain.
+
+    Each build gets its own ccache stats log, and kbs-cctime (ccache's prefix command, which only
+    runs on a miss) records how long each miss took to compile. The latest miss time for each
+    source is kept in the cache directory, to estimate the time saved by later hits.
+    """
+
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.times_path = cache_dir / "kbs-compile-times.json"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_args() -> List[str]:
+        # Command line variables are recursively expanded, so CROSS_PREFIX is resolved at use
+        return ["CC=ccache $(CROSS_PREFIX)gcc"]
+
+    def env(self, src_tree: Path, work_dir: Path) -> Dict[str, str]:
+        return {
+            **os.environ,
+            "CCACHE_DIR": str(self.cache_dir.resolve()),
+            # A bare number is read as GiB, so it is passed in MiB
+            "CCACHE_MAXSIZE": f"{self.max_size // 2**20}Mi",
+            # Group writable, for sharing a volume between containers mapped to the klipper user
+            "CCACHE_UMASK": "002",
+            "CCACHE_COMPILERCHECK": "content",
+            # Trees are checked out to different scratch paths for every build
+            "CCACHE_BASEDIR": str(src_tree.resolve()),
+            "CCACHE_NOHASHDIR": "1",
+            # autoconf.h is regenerated by every build, which would otherwise disable direct mode
+            "CCACHE_SLOPPINESS": "include_file_mtime,include_file_ctime",
+            "CCACHE_STATSLOG": str((work_dir / "ccache-stats.log").resolve()),
+            "CCACHE_PREFIX": "kbs-cctime",
+            "KBS_CCTIME_LOG": str((work_dir / "ccache-times.log").resolve()),
+        }
+
+    def collect(self, work_dir: Path) -> dict:
+        """Summarize a build's use of the cache, for build-meta.json"""
+        hit_sources = []
+        misses = 0
+        stats_log = work_dir / "ccache-stats.log"
+        if stats_log.exists():
+            source = None
+            for line in stats_log.read_text().splitlines():
+                if line.startswith("# "):
+                    source = line[2:]
+                elif line in HIT_COUNTERS:
+                    hit_sources.append(source)
+                elif line in MISS_COUNTERS:
+                    misses += 1
+            stats_log.unlink()
+
+        miss_times = {}
+        times_log = work_dir / "ccache-times.log"
+        if times_log.exists():
+            for line in times_log.read_text().splitlines():
+                source, _, micros = line.rpartition(" ")
+                miss_times[source] = int(micros) / 1_000_000
+            times_log.unlink()
+
+        with (self.cache_dir / ".kbs-lock").open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                known_times = json.loads(self.times_path.read_text())
+            except (FileNotFoundError, ValueError):
+                known_times = {}
+            known_times.update(miss_times)
+            self.times_path.write_text(json.dumps(known_times))
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        # Sources which have never been timed are assumed to take the average time
+        average_time = (
+            sum(known_times.values()) / len(known_times) if known_times else 0.0
+        )
+        saved_seconds = sum(known_times.get(s, average_time) for s in hit_sources)
+        compiles = len(hit_sources) + misses
+        return {
+            "hits": len(hit_sources),
+            "misses": misses,
+            "hit_rate": round(len(hit_sources) / compiles, 3) if compiles else None,
+            "miss_seconds": round(sum(miss_times.values()), 3),
+            "saved_seconds": round(saved_seconds, 3),
+        }
@@ -0,0 +1,227 @@
+import bisect
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from kbs_cache import resolve_revision
+
+logger = logging.getLogger()
+
+# Parsing a bundle takes far longer than checking a config against it, so the latest are kept
+KCONFIG_CACHE_SIZE = 8
+
+
+class PreflightError(Exception):
+    """A config which can't be built as asked, with the problems found"""
+
+    def __init__(self, message: str, problems: List[str]):
+        super().__init__(message)
+        self.problems = problems
+
+
+class UnknownRevision(Exception):
+    """A project or version the revdb doesn't have, which no config could be built for"""
+
+
+class PreflightUnavailable(Exception):
+    """A revdb which can't serve a revision it lists, which is no fault of the config"""
+
+
+@dataclass
+class PreflightResult(object):
+    git_sha: str
+    kconfig_hash: str
+    # As olddefconfig would leave it, which is what the build would end up with anyway
+    config: str
+    # Only the values that differ from the defaults, which equivalent configs share
+    min_config: str
+    # Assignments to symbols this revision doesn't have, and values that didn't stick
+    dropped: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+
+class RevdbIndex(object):
+    """A project's <project>.idx.json, from revdb/bin/make-index"""
+
+    def __init__(self, index_path: Path):
+        index = json.loads(index_path.read_text())
+        self.rows: List[list] = index["rows"]
+        self.bundles: List[list] = index["bundles"]
+        self.by_version: Dict[str, int] = index["by_version"]
+        self.by_sha: List[int] = index["by_sha"]
+        self._shas = [self.rows[i][0] for i in self.by_sha]
+
+    def find(self, version_or_sha: str) -> Optional[Tuple[str, str]]:
+        """
+        The commit and kconfig_hash of a describe string, or a full or abbreviated SHA
+
+        An abbreviated SHA that matches several commits finds nothing, as in kbs_revdb.js.
+        """
+        row_id = self.by_version.get(version_or_sha)
+        if row_id is None and len(version_or_sha) >= 7:
+            sha_prefix = version_or_sha.lower()
+            position = bisect.bisect_left(self._shas, sha_prefix)
+            matches = [
+                self.by_sha[i]
+                for i in range(position, min(position + 2, len(self._shas)))
+                if self._shas[i].startswith(sha_prefix)
+            ]
+            if len(matches) == 1:
+                row_id = matches[0]
+        if row_id is None:
+            return None
+        git_sha, _, bundle_id = self.rows[row_id]
+        return git_sha, self.bundles[bundle_id][0]
+
+
+class Preflight(object):
+    """
+    Checks configs against the revision's Kconfig, from the revdb's bundles, rather than a checkout
+
+    The revdb is a directory laid out as revdb/bin/from-gitref publishes it: <project>.idx.json and
+    kconfig-bundles/<project>/kconfig-<kconfig_hash>.tar. Versions the index doesn't know, such as
+    branch names, are resolved through the gitref, if there is one.
+
+    A config is loaded as olddefconfig would, so a config for an older revision comes out as the
+    build would see it. With strict set, assignments that would be dropped or changed on the way
+    are errors instead.
+    """
+
+    def __init__(self, revdb: Path, gitref: Optional[Path] = None, strict=False):
+        self.revdb = revdb
+        self.gitref = gitref
+        self.strict = strict
+        self._indexes: Dict[str, Tuple[int, RevdbIndex]] = {}
+        self._kconfigs: OrderedDict[str, object] = OrderedDict()
+        # Kconfigs hold the loaded config's values, and parsing sets the environment
+        self._lock = threading.Lock()
+        # Separate, so that looking up a version doesn't wait on a parse
+        self._index_lock = threading.Lock()
+        # Needs kconfiglib, which is only imported here, so the service can run without it
+        import kconfiglib
+
+        self._kconfiglib = kconfiglib
+
+    def projects(self) -> List[str]:
+        return sorted(
+            path.name[: -len(".idx.json")] for path in self.revdb.glob("*.idx.json")
+        )
+
+    def _index(self, project: str) -> RevdbIndex:
+        # Only names the revdb has are turned into paths
+        if project not in self.projects():
+            raise UnknownRevision(f"Unknown project {project}")
+        index_path = self.revdb / f"{project}.idx.json"
+        # Reloaded when the revdb is updated underneath us
+        with self._index_lock:
+            try:
+                mtime = index_path.stat().st_mtime_ns
+                if project not in self._indexes or self._indexes[project][0] != mtime:
+                    self._indexes[project] = (mtime, RevdbIndex(index_path))
+            except (OSError, ValueError, KeyError) as e:
+                logger.exception(f"Loading the index of {project} failed")
+                raise PreflightUnavailable(
+                    f"The index of {project} can't be loaded"
+                ) from e
+            return self._indexes[project][1]
+
+    def resolve(self, project: str, version: str) -> Tuple[str, str]:
+        """The commit and kconfig_hash of a version"""
+        index = self._index(project)
+        found = index.find(version)
+        if found is None and self.gitref:
+            try:
+                found = index.find(resolve_revision(self.gitref, project, version))
+            except ValueError:
+                pass
+        if found is None:
+            raise UnknownRevision(
+                f"Unknown version {version} of {project}: not a version, a branch, or a SHA "
+                "or prefix of exactly one commit"
+            )
+        return found
+
+    def _kconfig(self, project: str, kconfig_hash: str):
+        # Caller must hold the lock
+        if kconfig_hash in self._kconfigs:
+            self._kconfigs.move_to_end(kconfig_hash)
+            return self._kconfigs[kconfig_hash]
+        bundle_path = (
+            self.revdb / "kconfig-bundles" / project / f"kconfig-{kconfig_hash}.tar"
+        )
+        logger.info(f"Parsing Kconfig {kconfig_hash}")
+        try:
+            with tempfile.TemporaryDirectory() as srctree:
+                with tarfile.open(bundle_path, "r") as kconfig_tar:
+                    kconfig_tar.extractall(srctree, filter="data")
+                # As kbs_menuconfig does, since Kalico's extras aren't in the bundle
+                root_kconfig = Path(srctree) / "src" / "Kconfig"
+                if (
+                    'source "src/extras/Kconfig"\n'
+                    in root_kconfig.read_text().splitlines(True)
+                ):
+                    extras_path = Path(srctree) / "src" / "extras" / "Kconfig"
+                    extras_path.parent.mkdir(parents=True, exist_ok=True)
+                    extras_path.touch(exist_ok=True)
+                os.environ["srctree"] = srctree
+                kconf = self._kconfiglib.Kconfig("src/Kconfig", warn_to_stderr=False)
+        except (OSError, tarfile.TarError, self._kconfiglib.KconfigError) as e:
+            logger.exception(f"Loading Kconfig {kconfig_hash} of {project} failed")
+            raise PreflightUnavailable(
+                f"The Kconfig of this revision of {project} can't be loaded"
+            ) from e
+        while len(self._kconfigs) >= KCONFIG_CACHE_SIZE:
+            self._kconfigs.popitem(last=False)
+        self._kconfigs[kconfig_hash] = kconf
+        return kconf
+
+    def _user_value(self, sym) -> str:
+        if sym.orig_type in (self._kconfiglib.BOOL, self._kconfiglib.TRISTATE):
+            return self._kconfiglib.TRI_TO_STR[sym.user_value]
+        return sym.user_value
+
+    def check(self, project: str, version: str, config: str) -> PreflightResult:
+        start = time.monotonic()
+        git_sha, kconfig_hash = self.resolve(project, version)
+        with self._lock, tempfile.TemporaryDirectory() as scratch:
+            kconf = self._kconfig(project, kconfig_hash)
+            config_path = Path(scratch) / "config"
+            config_path.write_text(config)
+            kconf.warnings = []
+            kconf.load_config(str(config_path), replace=True)
+            dropped = [f"CONFIG_{name}={value}" for name, value in kconf.missing_syms]
+            if not any(s.user_value is not None for s in kconf.unique_defined_syms):
+                raise PreflightError(
+                    "Not a config for this revision", (dropped + kconf.warnings)[:10]
+                )
+            changed = [
+                f"CONFIG_{sym.name}={self._user_value(sym)} became {sym.str_value or 'unset'}"
+                for sym in kconf.unique_defined_syms
+                if sym.user_value is not None and self._user_value(sym) != sym.str_value
+            ]
+            kconf.write_config(str(config_path), header="", save_old=False)
+            min_config_path = Path(scratch) / "min_config"
+            kconf.write_min_config(str(min_config_path), header="")
+            result = PreflightResult(
+                git_sha,
+                kconfig_hash,
+                config_path.read_text(),
+                min_config_path.read_text(),
+                dropped,
+                changed,
+            )
+        if self.strict and (dropped or changed):
+            raise PreflightError(
+                "Config doesn't match this revision", result.dropped + result.changed
+            )
+        result.seconds = round(time.monotonic() - start, 4)
+        return result
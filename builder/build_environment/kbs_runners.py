@@ -0,0 +1,117 @@
+import asyncio
+import shlex
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+GITREF_IMAGE = "ghcr.io/laikulo/klipper-build-service/kbs_gitref:latest"
+BUILDENV_IMAGE = "ghcr.io/laikulo/klipper-build-service/kbs_buildenv:latest"
+
+# Stands in for the container, with the inbox and outbox on the host
+LOCAL_COMMAND = "kbs_builder --config {config} --outbox {outbox} -- {project} {version}"
+
+
+class BuildRunner(ABC):
+    """Runs a single build of the config in inbox/Kconfig, leaving the results in the outbox"""
+
+    @abstractmethod
+    def command(
+        self, project: str, version: str, inbox: Path, outbox: Path
+    ) -> List[str]:
+        """The command line of the build"""
+
+    async def run(
+        self,
+        project: str,
+        version: str,
+        inbox: Path,
+        outbox: Path,
+        on_line: Callable[[str], Awaitable[None]],
+    ) -> int:
+        """Run the build, passing each line of its output to on_line, and return its exit status"""
+        process = await asyncio.create_subprocess_exec(
+            *self.command(project, version, inbox, outbox),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+        try:
+            async for line in process.stdout:
+                await on_line(line.decode(errors="replace").rstrip("\n"))
+            return await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+
+class PodmanRunner(BuildRunner):
+    """Builds in the build environment container, as in the README"""
+
+    def __init__(
+        self,
+        buildenv_image: str = BUILDENV_IMAGE,
+        gitref_image: str = GITREF_IMAGE,
+        cache_dir: Optional[Path] = None,
+        ccache_dir: Optional[Path] = None,
+        podman: str = "podman",
+    ):
+        self.buildenv_image = buildenv_image
+        self.gitref_image = gitref_image
+        self.cache_dir = cache_dir
+        self.ccache_dir = ccache_dir
+        self.podman = podman
+
+    def command(
+        self, project: str, version: str, inbox: Path, outbox: Path
+    ) -> List[str]:
+        volumes = [
+            f"--mount=type=image,src={self.gitref_image},dst=/media/git",
+            f"--volume={inbox.resolve()}:/media/inbox:ro,z",
+            f"--volume={outbox.resolve()}:/media/outbox:rw,z",
+        ]
+        builder_args = []
+        if self.cache_dir:
+            volumes.append(f"--volume={self.cache_dir.resolve()}:/media/cache:rw,z")
+            builder_args += ["--cache-dir", "/media/cache"]
+        if self.ccache_dir:
+            volumes.append(f"--volume={self.ccache_dir.resolve()}:/media/ccache:rw,z")
+            builder_args += ["--ccache-dir", "/media/ccache"]
+        builder_args += ["--", project, version]
+        return [
+            self.podman,
+            "run",
+            "--rm",
+            "--net=none",
+            *volumes,
+            "--userns=keep-id:uid=1000",
+            self.buildenv_image,
+            *builder_args,
+        ]
+
+
+class LocalRunner(BuildRunner):
+    """
+    Runs a command on the host in place of the container, for running the service offline
+
+    {project}, {version}, {inbox}, {outbox} and {config} in the command are filled in for each
+    build. By default, that is kbs_builder itself, which needs the gitref at /media/git, but any
+    command that leaves a result.zip in the outbox will do.
+    """
+
+    def __init__(self, command_line: str = LOCAL_COMMAND):
+        self.command_line = command_line
+
+    def command(
+        self, project: str, version: str, inbox: Path, outbox: Path
+    ) -> List[str]:
+        return [
+            arg.format(
+                project=project,
+                version=version,
+                inbox=inbox.resolve(),
+                outbox=outbox.resolve(),
+                config=(inbox / "Kconfig").resolve(),
+            )
+            for arg in shlex.split(self.command_line)
+        ]
@@ -0,0 +1,135 @@
+import fcntl
+import logging
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from kbs_cache import resolve_revision
+
+logger = logging.getLogger()
+
+GITREF = Path("/media/git")
+
+
+class TreePool(object):
+    """
+    Pristine source trees, one per (project, commit), kept checked out between builds
+
+    Layout under the pool root:
+      <project>.git/      bare repo borrowing the gitref's objects, with the project's refs unprefixed
+      <project>/<sha>/    a worktree of that repo, never built in
+
+    Builds lease a copy of a pristine tree (reflinked, where the filesystem supports it). The copy's
+    .git is a private gitdir whose commondir is the project repo, and which carries a copy of the
+    pristine index. The project repo is configured to only check mtimes and sizes, which the copy
+    preserves, so `git describe --dirty` in the build sees a clean tree without rehashing it.
+    Leasing an already seen revision doesn't run git at all.
+    """
+
+    def __init__(self, root: Path, gitref: Path = GITREF, max_trees: int = 16):
+        self.root = root
+        self.gitref = gitref
+        self.max_trees = max_trees
+        self._thread_lock = threading.Lock()
+        root.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        # The thread lock covers workers in this process, flock covers other containers
+        with self._thread_lock, (self.root / ".lock").open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _git(self, git_dir: Path, *args: str, **kwargs) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            ["git", "--git-dir", str(git_dir), *args], check=True, **kwargs
+        )
+
+    def _gitref_stamp(self) -> str:
+        packed_refs = (self.gitref / "packed-refs").stat()
+        return f"{packed_refs.st_mtime_ns} {packed_refs.st_size}\n"
+
+    def _project_repo(self, project: str) -> Path:
+        # Caller must hold the lock
+        repo = self.root / f"{project}.git"
+        stamp_path = repo / "kbs-gitref-stamp"
+        if not repo.is_dir():
+            subprocess.run(["git", "init", "--bare", "-q", str(repo)], check=True)
+            (repo / "objects" / "info" / "alternates").write_text(
+                f"{(self.gitref / 'objects').resolve()}\n"
+            )
+            # Leased copies keep mtimes and sizes but not inodes or ctimes
+            self._git(repo, "config", "core.checkStat", "minimal")
+            self._git(repo, "config", "core.trustctime", "false")
+        if not stamp_path.exists() or stamp_path.read_text() != self._gitref_stamp():
+            # New or updated gitref, bring the project refs (used by describe) up to date
+            logger.info(f"Fetching {project} refs into tree pool")
+            self._git(
+                repo,
+                "fetch",
+                "-q",
+                str(self.gitref),
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--prune",
+                f"+refs/tags/{project}/*:refs/tags/*",
+                f"+refs/heads/{project}/*:refs/heads/*",
+            )
+            stamp_path.write_text(self._gitref_stamp())
+        return repo
+
+    def _pristine_tree(self, project: str, git_sha: str) -> Path:
+        # Caller must hold the lock
+        tree = self.root / project / git_sha
+        if tree.is_dir():
+            tree.touch()
+            return tree
+        repo = self._project_repo(project)
+        logger.info(f"Adding {project} {git_sha} to tree pool")
+        tree.parent.mkdir(exist_ok=True)
+        self._git(repo, "worktree", "add", "-q", "--detach", str(tree), git_sha)
+        self._evict()
+        return tree
+
+    def _evict(self) -> None:
+        # Caller must hold the lock
+        trees = [
+            (tree.stat().st_mtime, tree)
+            for project_dir in self.root.iterdir()
+            if project_dir.is_dir() and not project_dir.name.endswith(".git")
+            for tree in project_dir.iterdir()
+        ]
+        trees.sort()
+        for _, tree in trees[: max(0, len(trees) - self.max_trees)]:
+            logger.info(f"Evicting {tree.parent.name} {tree.name} from tree pool")
+            repo = self.root / f"{tree.parent.name}.git"
+            self._git(repo, "worktree", "remove", "--force", str(tree))
+
+    def lease(self, project: str, version: str, dest: Path) -> str:
+        """Place a clean checkout of the version at dest, returning the commit it resolved to"""
+        git_sha = resolve_revision(self.gitref, project, version)
+        # cp would copy the tree into an existing dest, rather than over it
+        if dest.is_symlink() or dest.is_file():
+            dest.unlink()
+        elif dest.exists():
+            logger.info(f"Replacing the tree left at {dest}")
+            shutil.rmtree(dest)
+        with self._locked():
+            tree = self._pristine_tree(project, git_sha)
+            subprocess.run(
+                ["cp", "-a", "--reflink=auto", str(tree), str(dest)], check=True
+            )
+        repo = (self.root / f"{project}.git").resolve()
+        # Swap the worktree's .git pointer for a private gitdir, so the lease can't disturb the pool
+        lease_git = dest / ".git"
+        lease_git.unlink()
+        lease_git.mkdir()
+        (lease_git / "commondir").write_text(f"{repo}\n")
+        (lease_git / "HEAD").write_text(f"{git_sha}\n")
+        shutil.copy2(repo / "worktrees" / git_sha / "index", lease_git / "index")
+        return git_sha
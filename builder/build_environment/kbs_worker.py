@@ -0,0 +1,196 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from kbs_batch import make_jobs_per_build
+from kbs_build import BuildJob, BuildResources, run_build
+
+logger = logging.getLogger()
+
+
+class JobSpool(object):
+    """
+    A directory based job queue
+
+    Each job is a directory holding job.json and the Kconfig to build. Jobs move between the state
+    directories by rename, which is atomic, so several workers (even in separate containers) can
+    share one spool. A job's results are written to the outbox directory inside it.
+
+    Workers hold a lock on each job directory while the job runs, so a job in running/ that
+    nobody holds was left there by a worker that died, and can be put back in incoming/.
+    """
+
+    STATES = ("new", "incoming", "running", "done", "failed")
+
+    def __init__(self, root: Path):
+        self.root = root
+        for state in self.STATES:
+            (root / state).mkdir(parents=True, exist_ok=True)
+        # The lock on each job this process is running, by job ID
+        self._locks: Dict[str, int] = {}
+
+    @staticmethod
+    def _lock(job_dir: Path) -> Optional[int]:
+        """Lock a job directory, returning the descriptor holding the lock, or None if it's held"""
+        try:
+            lock_fd = os.open(job_dir, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+        return lock_fd
+
+    def submit(self, project: str, version: str, config: bytes) -> str:
+        # Job IDs sort in submission order, so workers take the oldest job first
+        job_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        job_dir = self.root / "new" / job_id
+        job_dir.mkdir()
+        (job_dir / "Kconfig").write_bytes(config)
+        job_spec = {"project": project, "version": version, "submitted": time.time()}
+        (job_dir / "job.json").write_text(json.dumps(job_spec))
+        # Jobs are assembled in new/, so workers never see a partly written job
+        job_dir.rename(self.root / "incoming" / job_id)
+        return job_id
+
+    def claim(self) -> Optional[Path]:
+        for job_dir in sorted((self.root / "incoming").iterdir()):
+            claimed_dir = self.root / "running" / job_dir.name
+            try:
+                job_dir.rename(claimed_dir)
+            except FileNotFoundError:
+                # Another worker got to it first
+                continue
+            lock_fd = self._lock(claimed_dir)
+            if lock_fd is None:
+                # A starting worker took it for abandoned, and is putting it back
+                continue
+            self._locks[job_dir.name] = lock_fd
+            return claimed_dir
+        return None
+
+    def finish(self, job_dir: Path, succeeded: bool) -> Path:
+        finished_dir = self.root / ("done" if succeeded else "failed") / job_dir.name
+        job_dir.rename(finished_dir)
+        lock_fd = self._locks.pop(job_dir.name, None)
+        if lock_fd is not None:
+            os.close(lock_fd)
+        return finished_dir
+
+    def requeue_abandoned(self) -> int:
+        """Put jobs left in running/ by workers that died back in incoming/, returning how many"""
+        requeued = 0
+        for job_dir in sorted((self.root / "running").iterdir()):
+            lock_fd = self._lock(job_dir)
+            if lock_fd is None:
+                continue
+            try:
+                job_dir.rename(self.root / "incoming" / job_dir.name)
+                requeued += 1
+            except FileNotFoundError:
+                pass
+            finally:
+                os.close(lock_fd)
+        return requeued
+
+
+def run_job(
+    spool: JobSpool,
+    job_dir: Path,
+    scratch_root: Path,
+    resources: BuildResources,
+    make_jobs: Optional[int] = None,
+) -> None:
+    # Each job gets a scratch directory to itself, so concurrent checkouts don't collide
+    work_dir = scratch_root / job_dir.name
+    job = None
+    succeeded = False
+    try:
+        job_spec = json.loads((job_dir / "job.json").read_text())
+        outbox = job_dir / "outbox"
+        outbox.mkdir(exist_ok=True)
+        # A requeued job may have left one behind
+        shutil.rmtree(work_dir, ignore_errors=True)
+        work_dir.mkdir(parents=True)
+        job = BuildJob(
+            job_spec["project"],
+            job_spec["version"],
+            job_dir / "Kconfig",
+            outbox,
+            work_dir=work_dir,
+            make_jobs=make_jobs,
+        )
+        job.timings["queue_wait"] = round(time.time() - job_spec["submitted"], 3)
+        run_build(job, resources)
+        succeeded = True
+    except Exception:
+        logger.exception(f"Job {job_dir.name} failed")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        spool.finish(job_dir, succeeded)
+    breakdown = " ".join(f"{k}={v}s" for k, v in job.timings.items()) if job else ""
+    logger.info(
+        f"Job {job_dir.name} {'succeeded' if succeeded else 'failed'}: {breakdown}"
+    )
+
+
+def worker_loop(
+    spool: JobSpool,
+    scratch_root: Path,
+    resources: BuildResources,
+    drain: bool,
+    poll_interval: float,
+    make_jobs: Optional[int],
+) -> None:
+    while True:
+        job_dir = spool.claim()
+        if job_dir is None:
+            if drain:
+                return
+            time.sleep(poll_interval)
+            continue
+        run_job(spool, job_dir, scratch_root, resources, make_jobs)
+
+
+def run_worker(
+    spool: JobSpool,
+    scratch_root: Path,
+    jobs: int,
+    resources: BuildResources,
+    drain: bool = False,
+    poll_interval: float = 1.0,
+    make_jobs: Optional[int] = None,
+) -> None:
+    """Run jobs from the spool, several at once, until it is empty (if draining) or forever"""
+    # make's jobs are split between the slots, as between the builds of a batch
+    slot_make_jobs = make_jobs_per_build(jobs, make_jobs)
+    logger.info(
+        f"Worker starting with {jobs} slots of {slot_make_jobs} make jobs on {spool.root}"
+    )
+    requeued = spool.requeue_abandoned()
+    if requeued:
+        logger.info(f"Requeued {requeued} jobs left running by a previous worker")
+    with ThreadPoolExecutor(jobs) as pool:
+        slots = [
+            pool.submit(
+                worker_loop,
+                spool,
+                scratch_root,
+                resources,
+                drain,
+                poll_interval,
+                slot_make_jobs,
+            )
+            for _ in range(jobs)
+        ]
+        for slot in slots:
+            slot.result()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Check that a built engine loads the Kconfig snapshots make-bundles makes for it
+
+A small Kconfig bundle is snapshotted with revdb/bin/kconfig_snapshot.py, using the kconfiglib
+installed in the app directory, as from-gitref would with the engine's package. The snapshot is
+then loaded by the engine in the zipapp, with only what the zipapp holds, so a build that would
+quietly fall back to parsing every bundle fails here instead. Run it with the python the engine
+is built for.
+"""
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zipimport
+from pathlib import Path
+
+SNAPSHOT_SCRIPT = (
+    Path(__file__).resolve().parent.parent / "revdb/bin/kconfig_snapshot.py"
+)
+
+KCONFIG = """\
+mainmenu "kbs snapshot check"
+
+config KBS_CHECK
+    bool "A symbol"
+    default y
+"""
+
+
+def make_snapshot_bundle(app_dir: Path, scratch: Path) -> Path:
+    bundle_path = scratch / "kconfig.tar"
+    kconfig = KCONFIG.encode()
+    with tarfile.open(bundle_path, "w", format=tarfile.USTAR_FORMAT) as bundle:
+        info = tarfile.TarInfo("src/Kconfig")
+        info.size = len(kconfig)
+        bundle.addfile(info, io.BytesIO(kconfig))
+    snapshot_path = scratch / "kconfig.snap.tar.gz"
+    subprocess.run(
+        [sys.executable, SNAPSHOT_SCRIPT, bundle_path, snapshot_path],
+        env={**os.environ, "PYTHONPATH": str(app_dir.resolve())},
+        check=True,
+    )
+    return snapshot_path
+
+
+def load_engine(app: Path) -> dict:
+    # Only the zipapp is on the path, so the engine sees what it would in the VM
+    sys.path[:] = [str(app.resolve())] + [
+        p for p in sys.path if "site-packages" not in p
+    ]
+    engine = {"__name__": "kbs_menuconfig"}
+    exec(zipimport.zipimporter(str(app.resolve())).get_code("__main__"), engine)
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("app", type=Path, help="The built engine")
+    parser.add_argument(
+        "--app-dir",
+        type=Path,
+        default=Path("kbs_menuconfig.d"),
+        help="The directory it was built from",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        snapshot_path = make_snapshot_bundle(args.app_dir, Path(scratch))
+        engine = load_engine(args.app)
+        with tarfile.open(snapshot_path) as snapshot_tar:
+            snapshot_file = snapshot_tar.extractfile(engine["SNAPSHOT_NAME"])
+            kconf = engine["load_kconfig_snapshot"](snapshot_file)
+    if kconf is None or "KBS_CHECK" not in kconf.syms:
+        sys.exit(f"{args.app} doesn't load the snapshots made for it")
+    print(f"{args.app} loads snapshots")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Summarize a `python -X importtime` log, such as the one the engine sends to the browser when the
+VM is booted with kbs_importtime
+
+The total is the time spent importing, which is most of the engine's time to READY.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Iterable, List, NamedTuple
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def parse_importtime(lines: Iterable[str]) -> List[ImportTime]:
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header line, or other output that happened to land on stderr
+            continue
+        # Nested imports are indented, which doesn't matter here
+        imports.append(ImportTime(fields[2].strip(), int(fields[0]), int(fields[1])))
+    return imports
+
+
+def format_report(imports: List[ImportTime], top: int = 15) -> str:
+    lines = [
+        f"{len(imports)} modules imported in {sum(i.self_us for i in imports) / 1000:.1f}ms"
+    ]
+    for title, key in (("cumulative", "cumulative_us"), ("self", "self_us")):
+        lines.append(f"Slowest by {title} time:")
+        for entry in sorted(imports, key=lambda i: getattr(i, key), reverse=True)[:top]:
+            lines.append(f"  {getattr(entry, key) / 1000:8.1f}ms  {entry.module}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("log", type=Path, nargs="?", help="Defaults to stdin")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    if args.log is None:
+        imports = parse_importtime(sys.stdin)
+    else:
+        with args.log.open("r") as log_file:
+            imports = parse_importtime(log_file)
+    print(format_report(imports, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
+import collections
 import logging
 import os
 import sys
-from typing import Optional
+import time
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO, format=" - %(message)s")
@@ -30,15 +31,40 @@ When you are ready, press [Go!]
 
 def main():
     logger.info(f"KBS Menuconfig v{KBS_VER} starting up...")
-    # We import this during startup, so that we don't have a delay in the user critical path
+    send_timing("engine_start")
+    preload()
+    send_timing("preloaded")
+    if "importtime" in sys._xoptions:
+        send_import_profile()
+
+    while True:
+        proc_loop()
+
+
+def preload():
+    # We import this during startup, so that we don't have a delay in the user critical path.
+    # mkzipapp.py also calls this to trace which modules the engine needs.
     from kconfiglib import menuconfig
     import termios
     import tty
     import tarfile
+    import gzip
+    import hashlib
+    import io
+    import pickle
     import shutil
 
-    while True:
-        proc_loop()
+
+# autokconfig sends stderr here when the kbs_importtime kernel argument is given. Like anything
+# else sent to the browser, it has to be on the 9p root, not tmpfs
+IMPORTTIME_LOG = Path.home() / "kbs-importtime.log"
+
+
+def send_import_profile():
+    # Startup is over, so put stderr back on the terminal and hand the profile to the browser
+    os.dup2(sys.stdout.fileno(), sys.stderr.fileno())
+    if IMPORTTIME_LOG.exists():
+        send_file(IMPORTTIME_LOG)
 
 
 def proc_loop():
@@ -50,39 +76,66 @@ def proc_loop():
     print(BANNER)
     print(GO_PROMPT)
     # Inform the JS side that we are ready
+    send_timing("ready")
     send_immediate(chr(0x02))
     # Wait for the JS side to "say go"
-    wait_for_char(chr(0x07))
+    while True:
+        command, kconfig_hash = wait_for_command()
+        if command == CMD_LOAD or kconfig_hash in _kconfigs:
+            break
+        # Not loaded any more, so the JS side uploads the bundle and sends CMD_LOAD instead
+        send_timing("nak")
+        send_immediate(NAK)
     # Acknowledge that request
-    send_immediate(chr(0x06))
+    send_timing("command", "load" if command == CMD_LOAD else "reuse")
+    send_immediate(ACK)
     send_immediate("\x1bc")
     print(BANNER)
-    kconfig_tree = Path("klipper_kconfig")
     config_path = Path("klipper.config")
-    kconfig_archive = Path("/media/inbox/kconfig.tar")
     src_config_path = Path("/media/inbox/klipper.config")
     if src_config_path.exists():
         shutil.copy(src_config_path, config_path)
     else:
         config_path.write_text("# Empty example config file")
-    logger.info("Extracting Kconfig bundle...")
-    kconfig_tree.mkdir()
-    extract_kconfigs(kconfig_archive, kconfig_tree)
-    launch_menuconfig(str(kconfig_tree.resolve()), "src/Kconfig")
+    kconf = get_kconfig(kconfig_hash, command == CMD_LOAD)
+    send_timing("menuconfig_start")
+    launch_menuconfig(kconf)
+    send_timing("menuconfig_exit")
     logger.info("Sending config to browser...")
     send_file(config_path)
+    send_timing("exported")
     logger.info("Cleaning up...")
-    shutil.rmtree(kconfig_tree)
+    # The Kconfig is kept for the next cycle, which is likely to be for the same revision
     config_path.unlink()
     src_config_path.unlink(missing_ok=True)
-    kconfig_archive.unlink()
     logger.info("Complete")
+    send_timing("done")
     # Indicate completion of cycle
     send_immediate(chr(0x03))
 
 
 FSCMD_PATH = Path("/.fscmd")
 
+# From the JS side, each followed by a kconfig_hash and a CR
+CMD_LOAD = "\x07"  # The bundle for the hash has been put in the inbox
+CMD_REUSE = "\x12"  # The bundle for the hash was sent before, load it from the cache
+# To the JS side, in reply
+ACK = "\x06"
+NAK = "\x15"  # Can't reuse that bundle, send it
+
+# The browser sends whichever bundle variant it fetched
+KCONFIG_ARCHIVES = [
+    Path("/media/inbox/kconfig.tar.gz"),
+    Path("/media/inbox/kconfig.tar"),
+]
+
+
+def find_kconfig_archive():
+    for archive in KCONFIG_ARCHIVES:
+        if archive.exists():
+            return archive
+    raise FileNotFoundError("No Kconfig bundle in the inbox")
+
 
 def send_file(path: Path):
     FSCMD_PATH.write_text(f"export_file {path.resolve()}")
@@ -93,51 +146,178 @@ def send_immediate(in_data):
     sys.stdout.flush()
 
 
-def wait_for_char(char):
+# An OSC sequence, so xterm.js hands it to the JS side instead of displaying it
+TIMING_OSC = "\x1b]7777;kbs;"
+TIMING_ST = "\x1b\\"
+
+
+def send_timing(event: str, detail: str = ""):
+    """Tell the JS side that event happened, and when, in ms since the VM booted"""
+    # CLOCK_MONOTONIC starts at zero when the kernel boots
+    send_immediate(
+        f"{TIMING_OSC}{event};{time.monotonic() * 1000:.1f};{detail}{TIMING_ST}"
+    )
+
+
+def wait_for_command():
+    """Returns the next command from the JS side, and its kconfig_hash"""
     import termios
     import tty
 
     stdin_fd = sys.stdin.fileno()
     old_attr = termios.tcgetattr(stdin_fd)
     tty.setraw(stdin_fd)
-    while True:
-        if sys.stdin.read(1) == char:
-            break
+    command = sys.stdin.read(1)
+    while command not in (CMD_LOAD, CMD_REUSE):
+        command = sys.stdin.read(1)
+    kconfig_hash = ""
+    while (char := sys.stdin.read(1)) != "\r":
+        kconfig_hash += char
     termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old_attr)
+    return command, kconfig_hash
 
 
-def extract_kconfigs(archive, path):
+# Snapshot bundles start with the Kconfig already parsed, see revdb/bin/kconfig_snapshot.py
+SNAPSHOT_NAME = "kconfig.snapshot"
+SNAPSHOT_FORMAT = 2
+
+
+# tmpfs, so the tree never touches 9p, and costs nothing to throw away
+KCONFIG_TREE = Path("/dev/shm/klipper_kconfig")
+
+# Parsed Kconfigs are kept for reuse, by kconfig_hash, least recently used first
+KCONFIG_CACHE_SIZE = 3
+_kconfigs = collections.OrderedDict()
+
+
+def get_kconfig(kconfig_hash: str, uploaded: bool):
+    if uploaded:
+        archive = find_kconfig_archive()
+        if kconfig_hash in _kconfigs:
+            logger.info("Kconfig already loaded, ignoring the upload")
+            archive.unlink()
+            send_timing("kconfig_loaded", "cached")
+        else:
+            # Evicted first, so only one extra Kconfig is ever in memory while loading
+            while len(_kconfigs) >= KCONFIG_CACHE_SIZE:
+                _kconfigs.popitem(last=False)
+            _kconfigs[kconfig_hash] = load_bundle(archive)
+    else:
+        logger.info("Reusing the loaded Kconfig")
+        send_timing("kconfig_loaded", "cached")
+    _kconfigs.move_to_end(kconfig_hash)
+    return _kconfigs[kconfig_hash]
+
+
+def load_bundle(archive: Path):
+    """Parse a bundle from the browser, or load its snapshot, reading it over 9p just once"""
+    import io
+    import shutil
     import tarfile
 
-    kconfig_tar = tarfile.TarFile(archive)
-    kconfig_tar.extractall(path, filter="data")
+    data = archive.read_bytes()
+    archive.unlink()
+    send_timing("bundle_read", str(len(data)))
+    # Compression is detected from the content, not the name
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as kconfig_tar:
+        first_member = kconfig_tar.next()
+        if first_member is not None and first_member.name == SNAPSHOT_NAME:
+            logger.info("Loading Kconfig snapshot...")
+            try:
+                kconf = load_kconfig_snapshot(kconfig_tar.extractfile(first_member))
+            except Exception:
+                logger.exception("Loading the snapshot failed")
+                kconf = None
+            if kconf is not None:
+                send_timing("kconfig_loaded", "snapshot")
+                return kconf
+            logger.info("Snapshot is unusable here, parsing instead")
+        logger.info("Extracting Kconfig bundle...")
+        shutil.rmtree(KCONFIG_TREE, ignore_errors=True)
+        members = [m for m in kconfig_tar if m.name != SNAPSHOT_NAME]
+        root_kconfig = kconfig_tar.extractfile("src/Kconfig").read()
+        kconfig_tar.extractall(KCONFIG_TREE, members=members, filter="data")
+    send_timing("extracted")
     # Kalico gathers "firmware extras" into makefiles and Kconfig.
     # The following is to keep that from being breaking us
-    if is_kalico(path):
+    if is_kalico(root_kconfig):
         logger.info("Kalico detected, creating empty firmware-extras config")
-        extras_path = path / "src" / "extras" / "Kconfig"
+        extras_path = KCONFIG_TREE / "src" / "extras" / "Kconfig"
         extras_path.parent.mkdir(parents=True, exist_ok=True)
         extras_path.touch(exist_ok=True)
+    logger.info("Parsing Kconfig...")
+    kconf = parse_kconfig(str(KCONFIG_TREE), "src/Kconfig")
+    send_timing("kconfig_loaded", "parsed")
+    # Nothing is read from the tree once it is parsed
+    shutil.rmtree(KCONFIG_TREE)
+    return kconf
 
 
-def is_kalico(path):
+def is_kalico(root_kconfig: bytes):
     # We detect kalico by checking for the extras source line in the root Kconfig
     # Because the directory won't be in the kconfig bundle.
-    with (path / "src" / "Kconfig").open("r") as root_kconfig:
-        for line in root_kconfig:
-            if line == 'source "src/extras/Kconfig"\n':
-                return True
-        return False
+    return b'source "src/extras/Kconfig"\n' in root_kconfig.splitlines(keepends=True)
 
 
-def launch_menuconfig(srctree: Optional[str], kconfig_path: str):
-    import menuconfig
+def kconfiglib_distribution():
+    """The name and version of the package kconfiglib came from, which forks share VERSION with"""
+    try:
+        # Written into the app by mkbuildinfo.py, since the precompiled build has no .dist-info
+        from kbs_build_info import KCONFIGLIB_DISTRIBUTION
 
-    # menuconfig reads this from the environment, so we override it here
+        return KCONFIGLIB_DISTRIBUTION
+    except ImportError:
+        pass
+    # Run from the source tree, so the package metadata is on the path. Only imported here, as
+    # it's slow to import, and unused by builds.
+    import importlib.metadata
+    import kconfiglib
+
+    module_file = Path(kconfiglib.__file__).resolve()
+    for dist in importlib.metadata.distributions():
+        for path in dist.files or ():
+            if (
+                path.name == module_file.name
+                and Path(dist.locate_file(path)).resolve() == module_file
+            ):
+                return [dist.metadata["Name"], dist.version]
+    return None
+
+
+def load_kconfig_snapshot(snapshot_file):
+    import pickle
+    import kconfiglib
+
+    header = pickle.load(snapshot_file)
+    if (
+        not isinstance(header, dict)
+        or header.get("format") != SNAPSHOT_FORMAT
+        or tuple(header["kconfiglib"]) != kconfiglib.VERSION
+        or header["distribution"] != kconfiglib_distribution()
+    ):
+        return None
+    # The Kconfig comes first in the list of all its objects
+    objects, _ = pickle.load(snapshot_file)
+    return objects[0]
+
+
+def parse_kconfig(srctree: str, kconfig_path: str):
+    import kconfiglib
+
+    # kconfiglib reads this from the environment, so we override it here
     os.environ["srctree"] = srctree
+    # As menuconfig._main would, so that errors are reported without a traceback
+    return kconfiglib.Kconfig(kconfig_path, suppress_traceback=True)
+
+
+def launch_menuconfig(kconf):
+    from kconfiglib import menuconfig
+
+    # menuconfig reads this from the environment, so we override it here
     os.environ["KCONFIG_CONFIG"] = "klipper.config"
-    sys.argv = ["menuconfig", kconfig_path]
-    menuconfig._main()
+    # This replaces all the values from the last time the Kconfig was used
+    menuconfig.menuconfig(kconf)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Write kbs_build_info.py into the engine's app directory, recording what the engine was built with
+
+The precompiled build leaves package metadata (.dist-info) out of the zipapp, so the engine can't
+look up which kconfiglib it has at runtime. It reads this module instead, to tell whether a Kconfig
+snapshot was made with the same package.
+"""
+
+import argparse
+import importlib.metadata
+from pathlib import Path
+
+# How kconfiglib's module is laid out, by upstream kconfiglib and by kconfiglib-klipper
+KCONFIGLIB_FILES = ("kconfiglib.py", "kconfiglib/__init__.py")
+
+
+def kconfiglib_distribution(app_dir: Path):
+    for dist in importlib.metadata.distributions(path=[str(app_dir)]):
+        if any(str(path) in KCONFIGLIB_FILES for path in dist.files or ()):
+            return [dist.metadata["Name"], dist.version]
+    raise SystemExit(f"No kconfiglib package installed in {app_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("app_dir", type=Path)
+    args = parser.parse_args()
+
+    distribution = kconfiglib_distribution(args.app_dir)
+    lines = [
+        "# Written by mkbuildinfo.py",
+        f"KCONFIGLIB_DISTRIBUTION = {distribution!r}",
+    ]
+    (args.app_dir / "kbs_build_info.py").write_text("\n".join(lines) + "\n")
+    print(f"Engine built with {distribution[0]} {distribution[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3.12
+"""
+Build the engine as a zipapp of pre-compiled modules, for a quicker start in the VM
+
+This has to run on the same Python version as the VM, since that is what the bytecode is for.
+The engine's startup imports are traced, and the zip holds only .pyc files, in the order they are
+imported, so the VM neither compiles nor seeks around the archive while starting. The modules the
+trace pulled from the stdlib are written to a keep list, for shrink_py to trim the VM's stdlib
+with, and the import time profile of the trace is reported.
+
+Unlike the plain zipapp, this leaves out package metadata (.dist-info), so importlib.metadata
+finds nothing in it. What the engine needs to know about its packages is written into
+kbs_build_info.py by mkbuildinfo.py instead, and check_snapshot.py, run by the Makefile after
+either build, makes sure the engine still loads snapshots.
+"""
+
+import argparse
+import py_compile
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Dict, List
+
+from importtime_report import format_report, parse_importtime
+
+# The python in the VM's buildroot image
+TARGET_VERSION = (3, 12)
+
+# Not imported at startup, but needed if things go wrong, or by kconfiglib's $(shell)
+EXTRA_STDLIB = ["linecache", "subprocess", "traceback", "tokenize"]
+
+# Run in a fresh interpreter, so that only what the engine imports ends up in sys.modules. It
+# imports nothing itself, and runs the engine's source directly, as nothing compiled exists yet.
+TRACE_SCRIPT = """
+import sys
+app_dir = sys.argv[1]
+sys.path.insert(0, app_dir)
+engine = {"__name__": "kbs_menuconfig", "__file__": app_dir + "/__main__.py"}
+with open(engine["__file__"]) as source:
+    exec(compile(source.read(), engine["__file__"], "exec"), engine)
+engine["preload"]()
+for name in sys.argv[2:]:
+    __import__(name)
+print("\\n".join(getattr(m, "__file__", None) or "" for m in list(sys.modules.values())))
+"""
+
+# Fixed, so that the same inputs make the same archive
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def trace_imports(app_dir: Path):
+    """Returns the files of the modules the engine imports, in import order, and the profile"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TRACE_SCRIPT, app_dir]
+        + EXTRA_STDLIB,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    module_files = [Path(f).resolve() for f in result.stdout.splitlines() if f]
+    return module_files, result.stderr
+
+
+def archive_order(app_dir: Path, module_files: List[Path]) -> List[Path]:
+    sources = {
+        path
+        for path in app_dir.rglob("*")
+        if path.is_file()
+        # pip's console scripts, which run the host's python
+        and path.relative_to(app_dir).parts[0] != "bin"
+        and "__pycache__" not in path.parts
+        # Nothing reads package metadata at runtime, see kbs_build_info.py
+        and not any(part.endswith(".dist-info") for part in path.parts)
+        and path.suffix != ".pyc"
+    }
+    order = [app_dir / "__main__.py"]
+    order += [path for path in module_files if path in sources and path not in order]
+    order += sorted(sources - set(order))
+    return order
+
+
+def stdlib_keep_list(module_files: List[Path]) -> List[str]:
+    """The traced stdlib modules in import order, named as buildroot installs them: .pyc only"""
+    stdlib = Path(sysconfig.get_paths()["stdlib"]).resolve()
+    keep = {}
+    for path in module_files:
+        if not path.is_relative_to(stdlib) or path.suffix != ".py":
+            # Extension modules live in lib-dynload, which shrink_py keeps whole
+            continue
+        relative = path.relative_to(stdlib)
+        if relative.parts[0] in ("site-packages", "lib-dynload"):
+            continue
+        keep.setdefault(str(relative.with_suffix(".pyc")))
+    return list(keep)
+
+
+def write_zipapp(
+    app_dir: Path, files: List[Path], output: Path, interpreter: str, compress: bool
+) -> Dict[str, int]:
+    sizes = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        with output.open("wb") as output_file:
+            # Like zipapp, the zip follows a shebang line, which zipimport skips over
+            output_file.write(f"#!{interpreter}\n".encode())
+            with zipfile.ZipFile(
+                output_file,
+                "w",
+                compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+            ) as app_zip:
+                for path in files:
+                    name = path.relative_to(app_dir).as_posix()
+                    if path.suffix == ".py":
+                        # Unchecked, since there will be no source to compare against
+                        compiled = Path(scratch) / "module.pyc"
+                        py_compile.compile(
+                            path,
+                            cfile=compiled,
+                            dfile=name,
+                            doraise=True,
+                            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+                        )
+                        path, name = compiled, name + "c"
+                    data = path.read_bytes()
+                    app_zip.writestr(zipfile.ZipInfo(name, ZIP_DATE), data)
+                    sizes[name] = len(data)
+    output.chmod(0o755)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("app_dir", type=Path)
+    parser.add_argument("-o", "--output", type=Path, required=True)
+    parser.add_argument("-p", "--python", default="python3", help="The shebang")
+    parser.add_argument(
+        "--keep-list", type=Path, help="Where to write the stdlib keep list"
+    )
+    parser.add_argument(
+        "--importtime-log", type=Path, help="Where to write the traced profile"
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Deflate the modules, for a smaller but slower to load archive",
+    )
+    args = parser.parse_args()
+
+    if sys.version_info[:2] != TARGET_VERSION:
+        parser.error(
+            "Run this with python%d.%d, the version in the VM" % TARGET_VERSION
+        )
+
+    app_dir = args.app_dir.resolve()
+    module_files, profile = trace_imports(app_dir)
+    files = archive_order(app_dir, module_files)
+    sizes = write_zipapp(app_dir, files, args.output, args.python, args.compress)
+    print(f"{args.output}: {len(sizes)} files, {sum(sizes.values())} bytes")
+
+    if args.keep_list:
+        args.keep_list.write_text(
+            "".join(f"{name}\n" for name in stdlib_keep_list(module_files))
+        )
+    if args.importtime_log:
+        args.importtime_log.write_text(profile)
+    print(format_report(parse_importtime(profile.splitlines())))
+
+
+if __name__ == "__main__":
+    main()
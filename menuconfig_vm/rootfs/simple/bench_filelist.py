@@ -0,0 +1,98 @@
+#!/usr/bin/env python3.11
+"""
+Measure how long tinyemu_filelist takes to convert a rootfs tar, and its peak memory use
+
+Without a tar, a synthetic rootfs is generated: nested directories of small files, some of them
+duplicated, with the odd symlink and empty file, roughly in the proportions of the buildroot image.
+"""
+
+import argparse
+import io
+import random
+import tarfile
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from tinyemu_filelist import VirtualFS
+
+
+def make_rootfs(tar_path: Path, entries: int, seed: int):
+    rng = random.Random(seed)
+    shared_contents = [rng.randbytes(rng.randint(100, 8000)) for _ in range(20)]
+    directories = ["."]
+    with tarfile.open(tar_path, "w", format=tarfile.GNU_FORMAT) as rootfs:
+
+        def add(name, member_type, content=b"", linkname=""):
+            member = tarfile.TarInfo(name)
+            member.type = member_type
+            member.mode = 0o755 if member_type == tarfile.DIRTYPE else 0o644
+            member.mtime = 1_700_000_000
+            member.linkname = linkname
+            member.size = len(content)
+            rootfs.addfile(member, io.BytesIO(content))
+
+        add(".", tarfile.DIRTYPE)
+        for i in range(entries):
+            name = f"{rng.choice(directories)}/entry{i}"
+            kind = rng.random()
+            if kind < 0.1:
+                add(name, tarfile.DIRTYPE)
+                directories.append(name)
+            elif kind < 0.15:
+                add(name, tarfile.SYMTYPE, linkname=f"target{i}")
+            elif kind < 0.2:
+                add(name, tarfile.REGTYPE)
+            elif kind < 0.4:
+                add(name, tarfile.REGTYPE, rng.choice(shared_contents))
+            else:
+                add(name, tarfile.REGTYPE, rng.randbytes(rng.randint(1, 16000)))
+
+
+def convert(tar_path: Path, output_dir: Path, jobs: int, dedupe: bool):
+    """Returns the time taken by each phase, or the traced peak memory after it"""
+    marks = [time.perf_counter()]
+    peaks = []
+    vfs = VirtualFS(quiet=True)
+    with tarfile.open(tar_path) as in_tar:
+        vfs.from_tar(in_tar)
+        marks.append(time.perf_counter())
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        vfs.render_to_dir(output_dir, jobs, dedupe=dedupe)
+    marks.append(time.perf_counter())
+    peaks.append(tracemalloc.get_traced_memory()[1])
+    if tracemalloc.is_tracing():
+        return peaks
+    return [end - start for start, end in zip(marks, marks[1:])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("tar_path", nargs="?", type=Path)
+    parser.add_argument(
+        "--entries", type=int, default=50_000, help="Size of the synthetic rootfs"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("--dedupe", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        tar_path = args.tar_path
+        if tar_path is None:
+            tar_path = Path(scratch) / "rootfs.tar"
+            make_rootfs(tar_path, args.entries, args.seed)
+
+        # Timed without tracing, which slows allocation down a lot, then traced for memory
+        times = convert(tar_path, Path(scratch) / "timed", args.jobs, args.dedupe)
+        tracemalloc.start()
+        peaks = convert(tar_path, Path(scratch) / "traced", args.jobs, args.dedupe)
+        tracemalloc.stop()
+
+    for phase, seconds, peak in zip(("read", "render"), times, peaks):
+        print(f"{phase + ':':8}{seconds:.2f}s, peak {peak / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,42 @@
 #!/usr/bin/env python3.11
-from tinyemu_filelist import VirtualFS
+import argparse
 import tarfile
 from pathlib import Path
-from pprint import pprint as p
 
-# TODO: Make this all argparse-y
+from tinyemu_filelist import VirtualFS
+
+parser = argparse.ArgumentParser(
+    description="Convert a root filesystem tar into a tinyemu httpfs tree"
+)
+parser.add_argument(
+    "tar_path", nargs="?", type=Path, default=Path("buildroot/output/images/rootfs.tar")
+)
+parser.add_argument("output_dir", nargs="?", type=Path, default=Path("./httpfs"))
+parser.add_argument(
+    "-q", "--quiet", action="store_true", help="Don't print each member as it is read"
+)
+parser.add_argument(
+    "-j", "--jobs", type=int, help="Files to write at once, defaults to a few per CPU"
+)
+parser.add_argument(
+    "-i",
+    "--incremental",
+    action="store_true",
+    help="Update an existing output in place, keeping the IDs and blobs of unchanged files",
+)
+parser.add_argument(
+    "--dedupe",
+    action="store_true",
+    help="Store files with identical content once, under a shared ID",
+)
+args = parser.parse_args()
 
-in_tar = tarfile.open("buildroot/output/images/rootfs.tar")
+in_tar = tarfile.open(args.tar_path)
 
-vfs = VirtualFS()
+vfs = VirtualFS(quiet=args.quiet)
 vfs.from_tar(in_tar)
-vfs.render_to_dir(Path("./httpfs"))
+vfs.render_to_dir(args.output_dir, args.jobs, args.incremental, args.dedupe)
+if args.dedupe:
+    print(
+        f"{vfs.shared_files} duplicate files share a blob, saving {vfs.shared_bytes} bytes"
+    )
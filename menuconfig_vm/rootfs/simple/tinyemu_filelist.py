@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 import abc
+import collections
 import dataclasses
 from dataclasses import field, dataclass
+import errno
+import filecmp
+import hashlib
+import io
 import os
 import shutil
+import sys
+import threading
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import IntEnum
 from os import stat_result
 from pathlib import Path
 from tarfile import TarFile, TarInfo
-from typing import Optional, List, final, Union, Callable
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterable,
+    Optional,
+    List,
+    Iterator,
+    NamedTuple,
+    Set,
+    TextIO,
+    Tuple,
+    final,
+    Union,
+    Callable,
+)
 
 MODE_SHIFT = 3 * 4
+RENDER_CHUNK_SIZE = 1024 * 1024
+RENDER_QUEUE_DEPTH = 256
+FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
 
 
 class VirtualFsDataType(IntEnum):
@@ -34,6 +59,30 @@ class VirtualFsDataType(IntEnum):
         return (self.value << MODE_SHIFT) | in_mode
 
 
+def copy_range(src_fd: int, dst_fd: int, offset: int, count: int):
+    """Copy count bytes from offset in src_fd, to the current position of dst_fd"""
+    copiers = [
+        lambda pos, left: os.copy_file_range(src_fd, dst_fd, left, pos),
+        lambda pos, left: os.sendfile(dst_fd, src_fd, pos, left),
+        lambda pos, left: os.write(
+            dst_fd, os.pread(src_fd, min(left, RENDER_CHUNK_SIZE), pos)
+        ),
+    ]
+    copied = 0
+    while copied < count:
+        try:
+            done = copiers[0](offset + copied, count - copied)
+        except OSError as e:
+            # Not every filesystem pair supports these, so fall back to the next
+            if e.errno not in FALLBACK_ERRNOS or len(copiers) == 1:
+                raise
+            copiers.pop(0)
+            continue
+        if done == 0:
+            raise EOFError(f"Source ended {count - copied} bytes early")
+        copied += done
+
+
 def tar_basename(in_name):
     tok = in_name.rsplit("/", 1)
     if len(tok) > 1:
@@ -53,6 +102,12 @@ class VirtualFS(object):
     max_size: int = 2**30
     file_size_blocks: int = 0
     block_size: int = 4096
+    quiet: bool = False
+    # Set by render_to_dir, counting files listed with an ID another file already has
+    shared_files: int = 0
+    shared_bytes: int = 0
+    _tar_file: Optional[TarFile] = None
+    _tar_lock: threading.Lock = field(default_factory=threading.Lock)
 
     def to_dict(self):
         return {
@@ -63,7 +118,7 @@ class VirtualFS(object):
             "FSSize": self.file_size_blocks * self.block_size,
             "FSMaxSize": int(self.max_size),
             "Key": "",  # TODO: Figure out what this is for
-            "RootID": self.root_file_id,
+            "RootID": "%x" % self.root_file_id,
         }
 
     def assign_file_id(self):
@@ -94,23 +149,243 @@ class VirtualFS(object):
         self.root_file_id = self.assign_file_id()
         self.root_directory = VirtualFSDirectory.entity_from_path(self, tarfile, True)
 
-    def render_to_dir(self, target_dir):
+    def tar_extract(self, member: TarInfo):
+        return self._tar_file.extractfile(member)
+
+    @property
+    def tar_direct(self) -> bool:
+        """
+        If members can be read straight from the archive file, by offset
+
+        Members of an uncompressed archive are stored whole at their offset_data, so they can be
+        copied inside the kernel, from any thread, without going through the shared TarFile.
+        """
+        return isinstance(self._tar_file.fileobj, (io.BufferedReader, io.FileIO))
+
+    def tar_copy(self, source: Union[TarInfo, int], size: int, target: BinaryIO):
+        """
+        Copy a member's content into target, safe to call from several threads at once
+
+        The source is the member's offset, when tar_direct. Otherwise it is the member, which is
+        extracted through tarfile, one at a time.
+        """
+        if isinstance(source, TarInfo):
+            with self._tar_lock:
+                shutil.copyfileobj(self.tar_extract(source), target, RENDER_CHUNK_SIZE)
+        else:
+            copy_range(self._tar_file.fileobj.fileno(), target.fileno(), source, size)
+
+    def tar_hash(self, source: Union[TarInfo, int], size: int) -> bytes:
+        """The sha256 of a member's content, with the source as for tar_copy"""
+        content_hash = hashlib.sha256()
+        if isinstance(source, TarInfo):
+            with self._tar_lock:
+                member_file = self.tar_extract(source)
+                while chunk := member_file.read(RENDER_CHUNK_SIZE):
+                    content_hash.update(chunk)
+        else:
+            tar_fd = self._tar_file.fileobj.fileno()
+            for offset in range(0, size, RENDER_CHUNK_SIZE):
+                content_hash.update(
+                    os.pread(
+                        tar_fd, min(RENDER_CHUNK_SIZE, size - offset), source + offset
+                    )
+                )
+        return content_hash.digest()
+
+    def _load_previous(self) -> Optional["PreviousRender"]:
+        head_file = self.fs_dir / "head"
+        if not head_file.exists():
+            return None
+        head = dict(
+            line.split(": ", 1) for line in head_file.read_text().splitlines() if line
+        )
+        root_file_id = int(head["RootID"], 16)
+        with self.path_for_file(root_file_id).open("r") as listing:
+            files = read_listing(listing)
+        return PreviousRender(root_file_id, int(head["NextFileID"], 16), files)
+
+    def _reuse_files(self, previous: "PreviousRender", jobs: Optional[int]) -> Set[int]:
+        """Give unchanged files their previous IDs, returning the IDs which were kept"""
+        candidates = []
+        for path, node in self.root_directory.walk():
+            if not isinstance(node, VirtualFSFile) or node.get_size() == 0:
+                continue
+            if previous.files.get(path, (None,))[:3] == (
+                node.get_size(),
+                node.node_mtime,
+                node.node_mtime_nanos,
+            ):
+                candidates.append((node, previous.files[path][3]))
+
+        def unchanged(candidate):
+            node, file_id = candidate
+            old_blob = self.path_for_file(file_id)
+            if not old_blob.exists():
+                return False
+            with old_blob.open("rb") as old_file:
+                old_hash = hashlib.file_digest(old_file, "sha256").digest()
+            return old_hash == node.content_hash()
+
+        with ThreadPoolExecutor(jobs) as pool:
+            results = list(pool.map(unchanged, candidates))
+        kept = set()
+        for (node, file_id), is_unchanged in zip(candidates, results):
+            if is_unchanged:
+                node._node_file_id = file_id
+                kept.add(file_id)
+        return kept
+
+    def _share_duplicates(self, jobs: Optional[int]):
+        """Point files with identical content at a single blob"""
+        by_size = {}
+        for _, node in self.root_directory.walk():
+            if isinstance(node, VirtualFSFile) and node.get_size() > 0:
+                by_size.setdefault(node.get_size(), []).append(node)
+        # Only files which share a size with another can be duplicates, so only those are hashed
+        candidates = [n for nodes in by_size.values() if len(nodes) > 1 for n in nodes]
+        with ThreadPoolExecutor(jobs) as pool:
+            hashes = list(pool.map(lambda node: node.content_hash(), candidates))
+        by_content = {}
+        for node, content_hash in zip(candidates, hashes):
+            by_content.setdefault((node.get_size(), content_hash), []).append(node)
+        for nodes in by_content.values():
+            # An ID kept from a previous render is used if there is one, so its blob isn't
+            # rewritten. Any other kept IDs are dropped, which is safe, as their content is the same.
+            kept = [
+                node._node_file_id for node in nodes if node._node_file_id is not None
+            ]
+            file_id = min(kept) if kept else self.assign_file_id()
+            for node in nodes:
+                node._node_file_id = file_id
+
+    def render_to_dir(
+        self,
+        target_dir,
+        jobs: Optional[int] = None,
+        incremental: bool = False,
+        dedupe: bool = False,
+    ):
+        """
+        Write the filesystem out as a head file, and a files directory
+
+        When incremental, a previous render in the same directory is updated in place: files
+        whose path, size, mtime and content are unchanged keep their IDs, and their blobs aren't
+        rewritten. Changed files get IDs that were never used before, as does the root listing
+        if it changed, so nothing a client has cached is ever replaced with new content.
+        Blobs nothing refers to any more are removed, and head is replaced last.
+
+        When deduplicating, files with identical content are listed with the same file ID, so
+        their content is stored, and downloaded, once. Each still has its own inode in the guest.
+        """
         if target_dir:
             self.fs_dir = target_dir
         assert self.fs_dir is not None
         self.fs_dir.mkdir(exist_ok=True)
-        if not self.root_file_id:
-            self.root_file_id = self.assign_file_id()
         lock_file = self.fs_dir / "lock"
         lock_file.touch(exist_ok=True)
         files_path = self.fs_dir / "files"
         files_path.mkdir(exist_ok=True)
-        self.root_directory.render_to_dir(files_path)
-        head_file = self.fs_dir / "head"
-        head_file.write_text(self._head_text())
 
+        previous = self._load_previous() if incremental else None
+        kept_ids = set()
+        if previous:
+            self.next_file_id = max(self.next_file_id, previous.next_file_id)
+            kept_ids = self._reuse_files(previous, jobs)
+        if dedupe:
+            self._share_duplicates(jobs)
+        # Writing the listing numbers the remaining files
+        new_listing = self.fs_dir / "listing.new"
+        with new_listing.open("w") as listing:
+            self.root_directory.write_listing(listing)
+            listing_size = listing.tell()
+        if previous and filecmp.cmp(
+            new_listing, self.path_for_file(previous.root_file_id), shallow=False
+        ):
+            self.root_file_id = previous.root_file_id
+            kept_ids.add(self.root_file_id)
+            new_listing.unlink()
+        else:
+            if previous or not self.root_file_id:
+                self.root_file_id = self.assign_file_id()
+            new_listing.replace(self.path_for_file(self.root_file_id))
+        self.count_file_size(listing_size)
+
+        # File contents are independent of each other, so they are written concurrently
+        file_ids = {self.root_file_id}
+        # Shared blobs are written by the first file using them
+        written_ids = set(kept_ids)
+        with ThreadPoolExecutor(jobs) as pool:
+            renders = collections.deque()
+            for _, node in self.root_directory.walk():
+                if isinstance(node, VirtualFSFile) and node.get_size() > 0:
+                    self.count_file_size(node.get_size())
+                    if node._node_file_id in file_ids:
+                        self.shared_files += 1
+                        self.shared_bytes += node.get_size()
+                    file_ids.add(node._node_file_id)
+                    if node._node_file_id not in written_ids:
+                        written_ids.add(node._node_file_id)
+                        renders.append(pool.submit(node.render_to_dir, files_path))
+                    # Only a window of renders is queued, rather than one for every file
+                    if len(renders) > RENDER_QUEUE_DEPTH:
+                        renders.popleft().result()
+            for render in renders:
+                render.result()
 
-@dataclass
+        head_file = self.fs_dir / "head"
+        new_head_file = self.fs_dir / "head.new"
+        new_head_file.write_text(self._head_text())
+        new_head_file.replace(head_file)
+        if incremental:
+            # Kept IDs which deduplicating has since dropped have no files listed any more
+            kept_ids &= file_ids
+            for blob in files_path.iterdir():
+                if int(blob.name, 16) not in file_ids:
+                    blob.unlink()
+                    if not self.quiet:
+                        print(f"Removed {blob.name}")
+            if not self.quiet:
+                print(f"Kept {len(kept_ids)} blobs, wrote {len(file_ids - kept_ids)}")
+
+
+class PreviousRender(NamedTuple):
+    root_file_id: int
+    next_file_id: int
+    # size, mtime, mtime nanos, and file ID, of each non-empty file, by path
+    files: Dict[str, Tuple[int, int, int, int]]
+
+
+def read_listing(listing: Iterable[str]) -> Dict[str, Tuple[int, int, int, int]]:
+    """Find the non-empty files in the lines of a root listing, as written by VirtualFS"""
+    files = {}
+    directory = []
+    in_header = True
+    for line in listing:
+        line = line.rstrip("\n")
+        # Entries start after the blank line which ends the header
+        if in_header:
+            in_header = line != ""
+            continue
+        if line == ".":
+            if directory:
+                directory.pop()
+            continue
+        mode = int(line.split(" ", 1)[0], 8)
+        node_type = VirtualFsDataType.from_mode(mode)
+        if node_type == VirtualFsDataType.DIR:
+            directory.append(line.split(" ", 4)[4])
+        elif node_type == VirtualFsDataType.FILE:
+            _, _, _, size, mtime, rest = line.split(" ", 5)
+            if int(size):
+                name, file_id = rest.rsplit(" ", 1)
+                seconds, nanos = mtime.split(".")
+                path = "/".join(directory + [name])
+                files[path] = (int(size), int(seconds), int(nanos), int(file_id, 16))
+    return files
+
+
+@dataclass(slots=True)
 class VirtualFSObject(abc.ABC):
     _fs: VirtualFS
     _node_type = VirtualFsDataType.UNKN
@@ -248,7 +523,7 @@ class VirtualFSObject(abc.ABC):
         raise NotImplementedError
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSFifo(VirtualFSObject):
     _node_type = VirtualFsDataType.FIFO
 
@@ -267,7 +542,7 @@ class VirtualFSFifo(VirtualFSObject):
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSCharDev(VirtualFSObject):
     _node_type = VirtualFsDataType.CHAR
     node_dev_major: int = 0
@@ -286,12 +561,12 @@ class VirtualFSCharDev(VirtualFSObject):
         )
 
     def _load_from_stat(self, stat_obj: stat_result):
-        super()._load_from_stat(stat_obj)
+        super(VirtualFSCharDev, self)._load_from_stat(stat_obj)
         self.node_dev_major = os.major(stat_obj.st_rdev)
         self.node_dev_minor = os.minor(stat_obj.st_rdev)
 
     def _load_from_tarinfo(self, tarinfo: TarInfo):
-        super()._load_from_tarinfo(tarinfo)
+        super(VirtualFSCharDev, self)._load_from_tarinfo(tarinfo)
         self.node_dev_major = tarinfo.devmajor
         self.node_dev_minor = tarinfo.devminor
 
@@ -311,28 +586,14 @@ class VirtualFSCharDev(VirtualFSObject):
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSDirectory(VirtualFSObject):
     _node_type = VirtualFsDataType.DIR
-    __tar_tree = None
-    __tar_base = None
-    __tar_file: Optional[TarFile] = None
     children: List[VirtualFSObject] = field(default_factory=list)
 
     def get_size(self):
         return len(self.children)
 
-    def _self_dir_entry(self) -> str:
-        return super().dir_entry()
-
-    def dir_entry(self) -> str:
-        ret = []
-        if not self.is_root_dir:
-            ret.append(self._self_dir_entry())
-        ret += [e.dir_entry() for e in self.children]
-        ret.append(".")
-        return "\n".join(ret)
-
     @property
     def is_root_dir(self):
         return self._fs.root_directory == self
@@ -340,19 +601,32 @@ class VirtualFSDirectory(VirtualFSObject):
     def _header_text(self):
         return f"Version: {self._fs.version}\n" f"Revision: {self._fs.revision}\n" "\n"
 
-    def render_to_dir(self, files_dir: Path) -> None:
-        # If we are the root FS, we need to render the file tree
-        if self._fs.root_directory == self:
-            file_id = self._fs.root_file_id
-            listing_path = self._fs.path_for_file(file_id)
-            with listing_path.open("w+") as listing:
-                listing.write(self._header_text())
-                listing.write(self.dir_entry())
-                listing.write("\n")
-                self._fs.count_file_size(listing.tell())
-        # Render the children to disk (files only)
-        for child in self.children:
-            child.render_to_dir(files_dir)
+    def write_listing(self, out: TextIO) -> None:
+        """Write the root listing, which describes the whole tree, a line at a time"""
+        out.write(self._header_text())
+        # Each directory's line is followed by its contents, which are ended by a "." line
+        pending = [iter(self.children)]
+        while pending:
+            child = next(pending[-1], None)
+            if child is None:
+                pending.pop()
+                out.write(".\n")
+                continue
+            out.write(child.dir_entry())
+            out.write("\n")
+            if isinstance(child, VirtualFSDirectory):
+                pending.append(iter(child.children))
+
+    def walk(self) -> Iterator[Tuple[str, VirtualFSObject]]:
+        """Every node below this directory with its path from here, without recursion"""
+        pending = [("", self)]
+        while pending:
+            prefix, directory = pending.pop()
+            for child in directory.children:
+                path = prefix + child.node_filename
+                yield path, child
+                if isinstance(child, VirtualFSDirectory):
+                    pending.append((path + "/", child))
 
     @classmethod
     def entity_from_path(
@@ -367,92 +641,72 @@ class VirtualFSDirectory(VirtualFSObject):
                     VirtualFSObject.from_path(fs, f, recursive) for f in path.iterdir()
                 ]
         elif isinstance(path, TarFile):
-            obj.__tar_file = path
-            root_member = path.getmember(".")
-            obj._load_from_tarinfo(root_member)
-            # A tarfile's filename is always the root, which has no true name.
+            fs._tar_file = path
             obj.node_filename = "."
-            obj.__tar_base = "."  # Root of archive
-            obj.__build_tar_tree(path)
-            if recursive:
-                obj.__handle_tar_children()
+            obj.__ingest_tar(path, fs.quiet)
         else:
             raise NotImplementedError
         return obj
 
-    def __build_tar_tree(self, tar_file: TarFile):
-        self.__tar_tree = {}
-        for member in tar_file.getmembers():
-            member: TarInfo
-            tokens = member.path.rsplit("/", 1)
-            if len(tokens) > 1:
-                member_path = tokens[0]
-                member_name = tokens[1]
-            else:
-                member_path = ""
-                member_name = tokens[0]
-                if member_name == ".":
-                    # Skip the root node
-                    continue
-            if member_path not in self.__tar_tree:
-                self.__tar_tree[member_path] = []
-            self.__tar_tree[member_path].append(member_name)
-        pass
-
-    def __tar_children(self):
-        if self.__tar_base in self.__tar_tree:
-            return [
-                self.__tar_file.getmember(self.__tar_base + "/" + f)
-                for f in self.__tar_tree[self.__tar_base]
-            ]
-        else:
-            # Empty Directory
-            return []
-
-    def __handle_tar_children(self):
-        for child in self.__tar_children():
-            child: TarInfo
-            if child.isdir():
-                child_dir = VirtualFSDirectory.entity_from_tarinfo(
-                    self._fs, child, False
-                )
-                child_dir.__tar_file = self.__tar_file
-                child_dir.__tar_tree = self.__tar_tree
-                child_dir.__tar_base = child.path
-                child_dir.__handle_tar_children()
-                self.children.append(child_dir)
+    def __ingest_tar(self, tar_file: TarFile, quiet: bool):
+        """
+        Build the whole tree in one pass over the archive, as members are read
+
+        Directories are kept by their member path, so each member's parent is found in O(1).
+        Members are attached in archive order, which is the order they are listed and numbered in.
+        """
+        directories = {".": self}
+        # Members which arrive before their directory, by the path of that directory
+        waiting = {}
+        found_root = False
+        while (member := tar_file.next()) is not None:
+            # TarFile keeps every member it reads, but nodes only keep what they need from them
+            tar_file.members.clear()
+            if member.path == ".":
+                self._load_from_tarinfo(member)
+                found_root = True
+                continue
+            member_path = member.path.rsplit("/", 1)[0] if "/" in member.path else ""
+            child = VirtualFSObject.entity_from(self._fs, member)
+            if member.isdir():
+                directories[member.path] = child
+                child.children += waiting.pop(member.path, [])
+            if member_path in directories:
+                directories[member_path].children.append(child)
             else:
-                self.children.append(VirtualFSObject.entity_from(self._fs, child, True))
-            print(child)
-        pass
-
-    def tar_extract(self, member: TarInfo):
-        if not self.is_root_dir:
-            raise ValueError("Tried to extract tar data from non root")
-        return self.__tar_file.extractfile(member)
+                waiting.setdefault(member_path, []).append(child)
+            if not quiet:
+                print(member.path)
+        if not found_root:
+            raise KeyError("Archive has no root directory member '.'")
+        for member_path, children in waiting.items():
+            print(
+                f"Skipping {len(children)} entries in {member_path}, which isn't in the archive",
+                file=sys.stderr,
+            )
 
     @classmethod
     def entity_from_tarinfo(cls, fs, tarinfo: TarInfo, recursive=False):
+        # Children of tar directories are attached as the archive is read, see __ingest_tar
         obj = cls(fs)
         obj._load_from_tarinfo(tarinfo)
         obj.node_filename = tar_basename(tarinfo.name)
-        if recursive:
-            obj.__handle_tar_children()
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSBlockDevice(VirtualFSCharDev):
     _node_type = VirtualFsDataType.BLK
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSFile(VirtualFSObject):
     _node_type = VirtualFsDataType.FILE
     _node_file_id: Optional[int] = None
     _node_size: int = 0
     __source_file: Optional[Path] = None
-    __tar_info: Optional[TarInfo] = None
+    # The member's offset when the archive can be read directly, otherwise the member itself
+    __tar_source: Union[TarInfo, int, None] = None
 
     def get_size(self):
         return self._node_size
@@ -468,24 +722,31 @@ class VirtualFSFile(VirtualFSObject):
 
     def render_to_dir(self, files_dir: Path) -> None:
         if self.get_size() > 0:
-            if self.__tar_info:
-                self._fs.path_for_file(self._node_file_id).write_bytes(
-                    self._fs.root_directory.tar_extract(self.__tar_info).read()
-                )
+            if self.__tar_source is not None:
+                with self._fs.path_for_file(self._node_file_id).open("wb") as target:
+                    self._fs.tar_copy(self.__tar_source, self._node_size, target)
             elif self.__source_file:
                 shutil.copy(
                     self.__source_file, self._fs.path_for_file(self._node_file_id)
                 )
             else:
                 raise ValueError(f"Could not get content for file {self.node_filename}")
-            self._fs.count_file_size(self.get_size())
+
+    def content_hash(self) -> bytes:
+        if self.__tar_source is not None:
+            return self._fs.tar_hash(self.__tar_source, self._node_size)
+        elif self.__source_file:
+            with self.__source_file.open("rb") as source:
+                return hashlib.file_digest(source, "sha256").digest()
+        else:
+            raise ValueError(f"Could not get content for file {self.node_filename}")
 
     def _load_from_stat(self, stat_obj: stat_result):
-        super()._load_from_stat(stat_obj)
+        super(VirtualFSFile, self)._load_from_stat(stat_obj)
         self._node_size = stat_obj.st_size
 
     def _load_from_tarinfo(self, tarinfo: TarInfo):
-        super()._load_from_tarinfo(tarinfo)
+        super(VirtualFSFile, self)._load_from_tarinfo(tarinfo)
         self._node_size = tarinfo.size
 
     @classmethod
@@ -508,18 +769,21 @@ class VirtualFSFile(VirtualFSObject):
         obj._node_size = tarinfo.size
         obj.node_filename = tar_basename(tarinfo.name)
         if obj._node_size:
-            obj._node_file_id = fs.assign_file_id()
-            obj.__tar_info = tarinfo
+            # The ID is assigned when the listing is written, so IDs follow listing order
+            if fs.tar_direct and not tarinfo.issparse():
+                obj.__tar_source = tarinfo.offset_data
+            else:
+                obj.__tar_source = tarinfo
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSSymlink(VirtualFSObject):
     _node_type = VirtualFsDataType.LINK
     target: str = ""
 
     def dir_entry(self):
-        return super().dir_entry() + (" %s" % self.target)
+        return super(VirtualFSSymlink, self).dir_entry() + (" %s" % self.target)
 
     @classmethod
     def entity_from_path(cls, fs, path: Path, recursive=False) -> "VirtualFSObject":
@@ -538,7 +802,7 @@ class VirtualFSSymlink(VirtualFSObject):
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class VirtualFSSocket(VirtualFSObject):
     _node_type = VirtualFsDataType.SOCK
 
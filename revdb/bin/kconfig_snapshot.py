@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Parse a Kconfig bundle ahead of time, and save the result for the menuconfig engine to load
+
+Parsing is the slowest part of a menuconfig session in the VM, so the snapshot bundle variant
+starts with the parsed Kconfig, as kconfig.snapshot, ahead of the usual Kconfig files. That holds
+two pickles:
+  a header: {"format": SNAPSHOT_FORMAT, "kconfiglib": kconfiglib.VERSION,
+             "distribution": [the name of the package kconfiglib came from, its version]}
+  (objects, contents): every kconfiglib object, with the Kconfig first, then their contents
+
+kconfiglib's objects link to each other in long chains, deeper than pickle can recurse, so every
+object is pickled empty first, and the contents of each are then set on it by reference. All of
+that happens inside pickle.load(), so loading a snapshot costs no python code. kbs_menuconfig
+parses the files instead if the header doesn't match its own kconfiglib, down to the package, since
+kconfiglib-klipper and upstream kconfiglib have the same VERSION.
+"""
+
+import argparse
+import copyreg
+import functools
+import gzip
+import importlib.metadata
+import io
+import operator
+import os
+import pickle
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, List
+
+import kconfiglib
+
+SNAPSHOT_NAME = "kconfig.snapshot"
+SNAPSHOT_FORMAT = 2
+
+SNAPSHOT_CLASSES = (
+    kconfiglib.Kconfig,
+    kconfiglib.Symbol,
+    kconfiglib.Choice,
+    kconfiglib.MenuNode,
+    kconfiglib.Variable,
+)
+
+# Left over from parsing, and tied to files that are closed by now
+TRANSIENT_SLOTS = {"_readline"}
+
+CONTAINER_TYPES = (list, tuple, set, frozenset, dict)
+
+
+def _slots(obj) -> dict:
+    return {
+        name: getattr(obj, name)
+        for klass in type(obj).__mro__
+        for name in getattr(klass, "__slots__", ())
+        if name not in TRANSIENT_SLOTS and hasattr(obj, name)
+    }
+
+
+def collect_objects(kconf: kconfiglib.Kconfig) -> List[object]:
+    """Every kconfiglib object reachable from kconf, with kconf first"""
+    objects = [kconf]
+    seen = {id(kconf)}
+    for obj in objects:
+        pending = list(_slots(obj).values())
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                pending.extend(value.keys())
+                pending.extend(value.values())
+            elif isinstance(value, CONTAINER_TYPES):
+                pending.extend(value)
+            elif type(value) in SNAPSHOT_CLASSES and id(value) not in seen:
+                seen.add(id(value))
+                objects.append(value)
+    return objects
+
+
+class _Contents(object):
+    __slots__ = ("target",)
+
+    def __init__(self, target):
+        self.target = target
+
+
+class _SnapshotPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if type(obj) in SNAPSHOT_CLASSES:
+            # Only reached the first time an object is seen, which is in the list of them all
+            return copyreg.__newobj__, (type(obj),)
+        if type(obj) is _Contents:
+            # The object is in the memo by now, so this is ([ref], 0), and the state is set on
+            # whatever operator.getitem returns: the object itself
+            return operator.getitem, ([obj.target], 0), (None, _slots(obj.target))
+        return NotImplemented
+
+
+@functools.cache
+def kconfiglib_distribution() -> List[str]:
+    """The package the imported kconfiglib came from, even with several installed"""
+    module_file = Path(kconfiglib.__file__).resolve()
+    for dist in importlib.metadata.distributions():
+        for path in dist.files or ():
+            if (
+                path.name == module_file.name
+                and Path(dist.locate_file(path)).resolve() == module_file
+            ):
+                return [dist.metadata["Name"], dist.version]
+    raise RuntimeError(f"Can't tell which package {module_file} is from")
+
+
+def write_snapshot(kconf: kconfiglib.Kconfig, out: BinaryIO):
+    pickle.dump(
+        {
+            "format": SNAPSHOT_FORMAT,
+            "kconfiglib": kconfiglib.VERSION,
+            "distribution": kconfiglib_distribution(),
+        },
+        out,
+    )
+    objects = collect_objects(kconf)
+    _SnapshotPickler(out, protocol=4).dump(
+        (objects, [_Contents(obj) for obj in objects])
+    )
+
+
+def parse_tree(srctree: Path) -> kconfiglib.Kconfig:
+    """Parse as the engine does, including its fix for Kalico's firmware extras"""
+    root_kconfig = srctree / "src" / "Kconfig"
+    if 'source "src/extras/Kconfig"\n' in root_kconfig.read_text().splitlines(True):
+        extras_path = srctree / "src" / "extras" / "Kconfig"
+        extras_path.parent.mkdir(parents=True, exist_ok=True)
+        extras_path.touch(exist_ok=True)
+    os.environ["srctree"] = str(srctree)
+    return kconfiglib.Kconfig("src/Kconfig", warn=False)
+
+
+def write_snapshot_bundle(tar_path: Path, out: BinaryIO):
+    """The plain bundle at tar_path, gzipped, with the snapshot as its first member"""
+    with tempfile.TemporaryDirectory() as srctree:
+        with tarfile.open(tar_path, "r") as kconfig_tar:
+            kconfig_tar.extractall(srctree, filter="data")
+        snapshot = io.BytesIO()
+        write_snapshot(parse_tree(Path(srctree)), snapshot)
+
+    # No name and a zero mtime in the gzip header, as for the other compressed bundles
+    with gzip.GzipFile(
+        filename="", mode="wb", fileobj=out, compresslevel=9, mtime=0
+    ) as gz_file, tarfile.open(
+        fileobj=gz_file, mode="w", format=tarfile.USTAR_FORMAT
+    ) as snapshot_tar, tarfile.open(
+        tar_path, "r"
+    ) as kconfig_tar:
+        snapshot_info = tarfile.TarInfo(SNAPSHOT_NAME)
+        snapshot_info.size = snapshot.tell()
+        snapshot_info.mode = 0o644
+        snapshot_info.uname = snapshot_info.gname = "root"
+        snapshot.seek(0)
+        snapshot_tar.addfile(snapshot_info, snapshot)
+        for member in kconfig_tar:
+            snapshot_tar.addfile(member, kconfig_tar.extractfile(member))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("tar_path", type=Path, help="A plain kconfig bundle")
+    parser.add_argument("output_path", type=Path)
+    args = parser.parse_args()
+
+    with args.output_path.open("wb") as out:
+        write_snapshot_bundle(args.tar_path, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Read Kconfig trees straight out of a git object database, without a checkout
+
+The archive layout reproduces what GNU tar writes for
+  tar -c --sort=name --owner=root:0 --group=root:0 --mtime="UTC 1970-01-01" -H ustar FILES...
+byte for byte, so hashes match the checkout based kconfig-hash tool.
+File modes are those a checkout gets under the usual 022 umask.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+BLOCK_SIZE = 512
+# GNU tar's default blocking factor of 20
+RECORD_SIZE = BLOCK_SIZE * 20
+
+GIT_MODES = {
+    "100644": (0o644, b"0"),
+    "100755": (0o755, b"0"),
+    "120000": (0o777, b"2"),
+}
+
+
+class TreeEntry(NamedTuple):
+    path: str
+    git_mode: str
+    blob_sha: str
+
+
+class GitObjectReader(object):
+    """Reads objects from a repository through a long-running `git cat-file --batch`"""
+
+    def __init__(self, git_dir: Path):
+        self.git_dir = git_dir
+        self._proc = subprocess.Popen(
+            ["git", "-C", str(git_dir), "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read_object(self, object_name: str) -> Tuple[str, str, bytes]:
+        """Returns the object ID, type and content of any object name git understands"""
+        self._proc.stdin.write(object_name.encode() + b"\n")
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(f"Object {object_name} not found")
+        content = self._proc.stdout.read(int(header[2]))
+        # Each object is followed by a newline
+        self._proc.stdout.read(1)
+        return header[0].decode(), header[1].decode(), content
+
+    def read(self, object_name: str) -> bytes:
+        return self.read_object(object_name)[2]
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+def parse_tree(content: bytes) -> Iterator[Tuple[str, bytes, str]]:
+    """Yields the (mode, name, object ID) of each entry in a raw tree object"""
+    pos = 0
+    while pos < len(content):
+        space = content.index(b" ", pos)
+        nul = content.index(b"\0", space)
+        yield content[pos:space].decode(), content[space + 1 : nul], content[
+            nul + 1 : nul + 21
+        ].hex()
+        pos = nul + 21
+
+
+def _octal(value: int, width: int) -> bytes:
+    return b"%0*o\0" % (width - 1, value)
+
+
+def _split_name(path: bytes):
+    # Same split as GNU tar: the longest prefix that fits, ending at a slash
+    if len(path) <= 100:
+        return b"", path
+    length = min(len(path), 156)
+    split = path.rfind(b"/", 0, length)
+    if split <= 0 or len(path) - split - 1 > 100:
+        raise ValueError(f"Path too long for ustar: {path}")
+    return path[:split], path[split + 1 :]
+
+
+def ustar_header(path: str, mode: int, size: int, typeflag=b"0", linkname=b"") -> bytes:
+    prefix, name = _split_name(path.encode())
+    header = b"".join(
+        [
+            name.ljust(100, b"\0"),
+            _octal(mode, 8),
+            _octal(0, 8),  # uid
+            _octal(0, 8),  # gid
+            _octal(size, 12),
+            _octal(0, 12),  # mtime
+            b" " * 8,  # checksum, counted as spaces
+            typeflag,
+            linkname.ljust(100, b"\0"),
+            b"ustar\x0000",
+            b"root".ljust(32, b"\0"),
+            b"root".ljust(32, b"\0"),
+            _octal(0, 8),  # devmajor
+            _octal(0, 8),  # devminor
+            prefix.ljust(155, b"\0"),
+        ]
+    ).ljust(BLOCK_SIZE, b"\0")
+    checksum = b"%06o\0 " % sum(header)
+    return header[:148] + checksum + header[156:]
+
+
+def write_ustar(
+    out: BinaryIO, reader: GitObjectReader, entries: Iterable[TreeEntry]
+) -> None:
+    """Write entries as a deterministic ustar archive, in the order given"""
+    written = 0
+    for entry in entries:
+        mode, typeflag = GIT_MODES[entry.git_mode]
+        content = reader.read(entry.blob_sha)
+        if typeflag == b"2":
+            # Symlinks are stored with their target, and no content
+            block = ustar_header(entry.path, mode, 0, typeflag, content)
+        else:
+            padding = -len(content) % BLOCK_SIZE
+            block = (
+                ustar_header(entry.path, mode, len(content), typeflag)
+                + content
+                + b"\0" * padding
+            )
+        out.write(block)
+        written += len(block)
+    # Two empty blocks mark the end, then the archive is padded to a full record
+    trailer = BLOCK_SIZE * 2
+    trailer += -(written + trailer) % RECORD_SIZE
+    out.write(b"\0" * trailer)
+
+
+class _HashWriter(object):
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        self.hash.update(data)
+
+
+class TreeWalker(object):
+    """
+    Finds the files in a tree whose name matches, remembering the matches under each tree ID
+
+    Successive commits share most of their subtrees, so walking one commit after another only
+    reads the subtrees that changed in between.
+    """
+
+    def __init__(self, reader: GitObjectReader, match: Callable[[str], bool]):
+        self.reader = reader
+        self.match = match
+        self._found: Dict[str, Tuple[TreeEntry, ...]] = {}
+
+    def _find_relative(self, tree_id: str) -> Tuple[TreeEntry, ...]:
+        if tree_id not in self._found:
+            found = []
+            for mode, name, object_id in parse_tree(self.reader.read(tree_id)):
+                name = name.decode()
+                if mode == "40000":
+                    found += [
+                        e._replace(path=f"{name}/{e.path}")
+                        for e in self._find_relative(object_id)
+                    ]
+                elif mode in GIT_MODES and self.match(name):
+                    found.append(TreeEntry(name, mode, object_id))
+            self._found[tree_id] = tuple(found)
+        return self._found[tree_id]
+
+    def find(self, tree_id: str, prefix: str = "") -> List[TreeEntry]:
+        """Matching files in the tree, in tree order"""
+        return [e._replace(path=prefix + e.path) for e in self._find_relative(tree_id)]
+
+
+def blob_set_key(entries: Iterable[TreeEntry]) -> str:
+    """A key for a set of Kconfigs, equal whenever they would archive identically"""
+    key_hash = hashlib.sha256()
+    for entry in entries:
+        key_hash.update(f"{entry.git_mode} {entry.blob_sha} {entry.path}\0".encode())
+    return key_hash.hexdigest()
+
+
+class KconfigHasher(object):
+    """
+    Computes kconfig hashes for commits, memoized so unchanged Kconfigs cost next to nothing
+
+    Trees are walked through the object reader, and the Kconfigs found under each tree are
+    remembered by tree ID, so only subtrees a commit changed are read. Hashes are remembered by
+    the src tree ID, and by the set of Kconfig blobs, so a commit which doesn't touch src, or
+    doesn't touch any Kconfig, is resolved from the memo without building an archive.
+    The memo can be saved and loaded, to carry it between runs.
+    """
+
+    def __init__(self, reader: GitObjectReader, memo: Optional[Dict[str, str]] = None):
+        self.reader = reader
+        # Both src tree IDs and blob set keys map to hashes, they can't collide
+        self.memo: Dict[str, str] = memo if memo is not None else {}
+        # kconfig-hash finds them with `find -iname`
+        self._walker = TreeWalker(reader, lambda name: name.lower() == "kconfig")
+
+    @classmethod
+    def with_memo_file(cls, reader: GitObjectReader, memo_path: Path):
+        try:
+            memo = json.loads(memo_path.read_text())
+        except FileNotFoundError:
+            memo = {}
+        return cls(reader, memo)
+
+    def save_memo(self, memo_path: Path) -> None:
+        memo_path.write_text(json.dumps(self.memo, sort_keys=True))
+
+    def _src_tree(self, commit: str) -> Optional[str]:
+        try:
+            object_id, object_type, _ = self.reader.read_object(f"{commit}:src")
+        except KeyError:
+            return None
+        return object_id if object_type == "tree" else None
+
+    def entries(self, commit: str) -> List[TreeEntry]:
+        """The Kconfigs kconfig-hash archives: `find src -iname Kconfig | LC_ALL=C sort`"""
+        src_tree = self._src_tree(commit)
+        if src_tree is None:
+            return []
+        entries = self._walker.find(src_tree, prefix="src/")
+        return sorted(entries, key=lambda e: e.path.encode())
+
+    def hash_commit(self, commit: str) -> str:
+        """The hash kconfig-hash would print for a checkout of commit"""
+        src_tree = self._src_tree(commit)
+        if src_tree in self.memo:
+            return self.memo[src_tree]
+        entries = self.entries(commit)
+        blobs_key = blob_set_key(entries)
+        if blobs_key not in self.memo:
+            sink = _HashWriter()
+            write_ustar(sink, self.reader, entries)
+            self.memo[blobs_key] = sink.hash.hexdigest()
+        if src_tree is not None:
+            self.memo[src_tree] = self.memo[blobs_key]
+        return self.memo[blobs_key]
+
+
+def verify(git_dir: Path, commit: str, expected: str) -> bool:
+    """Check a hash against kconfig-hash run on a real checkout of the commit"""
+    legacy_tool = Path(__file__).resolve().parent / "kconfig-hash"
+    with tempfile.TemporaryDirectory() as scratch:
+        checkout = Path(scratch) / "checkout"
+        subprocess.run(
+            ["git", "-C", str(git_dir), "worktree", "add", "-q", "--detach"]
+            + [str(checkout), commit],
+            check=True,
+        )
+        try:
+            legacy_hash = subprocess.run(
+                [str(legacy_tool), str(checkout)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        finally:
+            subprocess.run(
+                ["git", "-C", str(git_dir), "worktree", "remove", "--force"]
+                + [str(checkout)],
+                check=True,
+            )
+    if legacy_hash != expected:
+        print(f"{commit}: kconfig-hash gave {legacy_hash}", file=sys.stderr)
+    return legacy_hash == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the kconfig hash of each commit, without checking it out"
+    )
+    parser.add_argument("commits", metavar="COMMIT", nargs="+")
+    parser.add_argument("-C", dest="git_dir", type=Path, default=Path.cwd())
+    parser.add_argument(
+        "--memo", type=Path, help="File to keep computed hashes in between runs"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check each hash against kconfig-hash on a checkout, exiting 1 on a mismatch",
+    )
+    args = parser.parse_args()
+
+    # Checkouts made for verification get the modes the archive assumes
+    os.umask(0o022)
+    reader = GitObjectReader(args.git_dir)
+    if args.memo:
+        hasher = KconfigHasher.with_memo_file(reader, args.memo)
+    else:
+        hasher = KconfigHasher(reader)
+    all_match = True
+    for commit in args.commits:
+        kconfig_hash = hasher.hash_commit(commit)
+        print(kconfig_hash)
+        if args.verify:
+            all_match &= verify(args.git_dir, commit, kconfig_hash)
+    reader.close()
+    if args.memo:
+        hasher.save_memo(args.memo)
+    sys.exit(0 if all_match else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
 VM_STATES = ["OFF", "BOOTING", "READY", "RUNNING", "RESETTING"];
 window.vm_state = 0; // Default to OFF
+// kconfig_hashes the engine has loaded, which it may still have cached
+window.vm_kconfig_hashes = new Set();
+// The revision of the launch waiting on the engine's ACK or NAK
+window.vm_pending_revision = null;
+// Timing events from VM start up, and from each session, see kbs_dump_timings
+window.kbs_timings = { boot: [], sessions: [] };
 
 // Called by the WASM side
 function on_file_export(filename, data) {
   if (filename === "klipper.config") {
     on_config_generated(data);
+  } else if (filename === "kbs-importtime.log") {
+    on_importtime_log(data);
   } else {
     alert(filename + " unexpectedly exported ignoring it");
     console.log(data);
@@ -12,10 +20,17 @@ function on_file_export(filename, data) {
 }
 
 function on_config_generated(config_data) {
+  timing_event("browser", "config_received");
   window.current_config = config_data;
   modal("config_done");
 }
 
+// Sent when the VM is booted with kbs_importtime on the kernel command line
+async function on_importtime_log(log_data) {
+  window.kbs_importtime_log = await log_data.text();
+  console.log(window.kbs_importtime_log);
+}
+
 function discard_config() {
   window.current_config = null;
   modal(null);
@@ -36,7 +51,7 @@ function download_config(filename) {
 async function reconfigure() {
   modal();
   launch_kconfig(
-    get_selected_ver().getKConfigBundleUrl(),
+    get_selected_ver(),
     await window.current_config.arrayBuffer(),
   );
 }
@@ -86,15 +101,16 @@ function run_menuconfig_v3(ev) {
     }
     file_list = file_chooser;
   }
-  let kconfig_bundle_url =
-    window.kconfig_project.revisions[
-      document.getElementById("form_v3_version").selectedOptions[0].value
-    ].getKConfigBundleUrl();
-  launch_kconfig(kconfig_bundle_url, file_list);
+  launch_kconfig(get_selected_ver(), file_list);
   return false;
 }
 
-function launch_kconfig(kconfig_bundle_url, conf_file) {
+function launch_kconfig(revision, conf_file) {
+  window.kbs_timings.sessions.push({
+    kconfig_hash: revision.kconfig_hash,
+    events: [],
+  });
+  timing_event("browser", "launch");
   if (conf_file) {
     if (obj_type(conf_file) === "ArrayBuffer") {
       send_file_to_vm("klipper.config", conf_file);
@@ -113,12 +129,32 @@ function launch_kconfig(kconfig_bundle_url, conf_file) {
       throw "Unexpected config file, not buffer or upload";
     }
   }
+  window.vm_pending_revision = revision;
+  if (window.vm_kconfig_hashes.has(revision.kconfig_hash)) {
+    // The engine NAKs this if it has dropped the Kconfig, see proc_vm_input
+    timing_event("browser", "command_sent", "reuse");
+    send_chars_to_vm("\x12" + revision.kconfig_hash + "\r");
+    window.vm_terminal.focus();
+  } else {
+    upload_bundle(revision);
+  }
+}
+
+function upload_bundle(revision) {
+  let kconfig_bundle_url = revision.getKConfigBundleUrl();
+  // The guest sniffs the compression, so a server which decodes the gzip on the way is fine
+  let bundle_name = kconfig_bundle_url.pathname.endsWith(".tar.gz")
+    ? "kconfig.tar.gz"
+    : "kconfig.tar";
+  timing_event("browser", "fetch_start", kconfig_bundle_url.pathname);
   fetch(kconfig_bundle_url)
     .then((response) => {
       if (response.ok) {
         response.arrayBuffer().then((buf) => {
-          send_file_to_vm("kconfig.tar", buf);
-          send_chars_to_vm("\x07");
+          timing_event("browser", "fetch_done", buf.byteLength.toString());
+          send_file_to_vm(bundle_name, buf);
+          timing_event("browser", "command_sent", "load");
+          send_chars_to_vm("\x07" + revision.kconfig_hash + "\r");
           window.vm_terminal.focus();
         });
       } else {
@@ -142,9 +178,82 @@ function send_chars_to_vm(chars) {
   window.term_handler(chars);
 }
 
-/* Special returns:
+/* Timing events come from the browser, or the engine ("guest"), as:
+ * ESC ] 7777 ; kbs ; <event> ; <ms since the VM booted> ; <detail> ESC \
+ * Each gets the browser's own time on arrival too, which is what spans the two.
+ */
+function timing_event(source, name, detail, guest_ms) {
+  let sessions = window.kbs_timings.sessions;
+  // Everything up to the first launch is VM start up
+  let events = sessions.length
+    ? sessions[sessions.length - 1].events
+    : window.kbs_timings.boot;
+  events.push({
+    source: source,
+    name: name,
+    detail: detail || "",
+    browser_ms: performance.now(),
+    guest_ms: guest_ms,
+  });
+}
+
+function on_timing_osc(data) {
+  let fields = data.split(";");
+  if (fields[0] !== "kbs" || fields.length !== 4) {
+    return false; // Not ours, let xterm.js deal with it
+  }
+  timing_event("guest", fields[1], fields[3], parseFloat(fields[2]));
+  return true;
+}
+
+/* The time between each event and the one before it. Between two engine events,
+ * that is by the VM's clock, otherwise by the browser's.
+ */
+function timing_breakdown(events) {
+  let breakdown = [];
+  for (let i = 1; i < events.length; i++) {
+    let prev = events[i - 1];
+    let cur = events[i];
+    let both_guest = cur.source === "guest" && prev.source === "guest";
+    breakdown.push({
+      phase: prev.name + " -> " + cur.name,
+      ms: both_guest
+        ? cur.guest_ms - prev.guest_ms
+        : cur.browser_ms - prev.browser_ms,
+      detail: cur.detail,
+    });
+  }
+  return breakdown;
+}
+
+// For benchmarking, from the console: copy(kbs_dump_timings())
+function kbs_dump_timings() {
+  let dump = {
+    boot: {
+      events: window.kbs_timings.boot,
+      breakdown: timing_breakdown(window.kbs_timings.boot),
+    },
+    sessions: window.kbs_timings.sessions.map((session) => ({
+      kconfig_hash: session.kconfig_hash,
+      events: session.events,
+      breakdown: timing_breakdown(session.events),
+    })),
+  };
+  console.table(dump.boot.breakdown);
+  for (let session of dump.sessions) {
+    console.table(session.breakdown);
+  }
+  return JSON.stringify(dump, null, 2);
+}
+
+/* Start commands, each followed by the kconfig_hash and a CR:
+ * ASCII BEL 0x07 - Load the bundle just put in the inbox
+ * ASCII DC2 0x12 - Reuse the Kconfig the engine loaded for that hash before
+ *
+ * Special returns:
  * ASCII SOT 0x02 - Ready
  * ASCII ACK 0x06 - Ack start comand
+ * ASCII NAK 0x15 - Can't reuse that Kconfig, upload the bundle instead
  * ASCII EOT 0x03 - Done
  */
 function proc_vm_input(str) {
@@ -157,6 +266,13 @@ function proc_vm_input(str) {
       if (window.vm_state === 2) {
         vm_state_change(3);
       }
+      if (window.vm_pending_revision) {
+        window.vm_kconfig_hashes.add(window.vm_pending_revision.kconfig_hash);
+        window.vm_pending_revision = null;
+      }
+    } else if (c === "\x15" && window.vm_pending_revision) {
+      window.vm_kconfig_hashes.delete(window.vm_pending_revision.kconfig_hash);
+      upload_bundle(window.vm_pending_revision);
     }
   }
   return str;
@@ -169,6 +285,7 @@ let setupTerm = (cols, rows, handler) => {
     cursorBlink: true,
   });
   web_terminal.onData(handler);
+  web_terminal.parser.registerOscHandler(7777, on_timing_osc);
   web_terminal.open(document.getElementById("terminal"));
   window.vm_terminal = web_terminal;
   window.vm_input = handler;
@@ -273,6 +390,7 @@ window.kbs_init = function () {
     return;
   }
   document.getElementById("kconfig_form_v3").onsubmit = run_menuconfig_v3;
+  timing_event("browser", "vm_start");
   start_vm(null, null, setupTerm, {
     url: "menuconfig-riscv64.cfg",
     scriptBase: "jslinux/",
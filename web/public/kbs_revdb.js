@@ -19,8 +19,9 @@ class KBSRevisionProject {
   constructor(repo, project_name) {
     this.repo = repo;
     this.project_name = project_name;
-    this.csv_data = null;
+    this.index = null;
     this.revisions = null;
+    this._index_promise = null;
   }
 
   async getCSV() {
@@ -36,34 +37,150 @@ class KBSRevisionProject {
     }
   }
 
+  async getIndexData() {
+    let index_url = new URL(
+      this.repo.base_url + "/" + this.project_name + ".idx.json",
+      window.location,
+    );
+    let index_resp = await fetch(index_url);
+    if (index_resp.ok) {
+      return index_resp.json();
+    } else {
+      return null;
+    }
+  }
+
+  // Loaded once, on first use. A revdb without an index gets one built from its CSV
+  getIndex() {
+    if (!this._index_promise) {
+      this._index_promise = (async () => {
+        let index_data = await this.getIndexData().catch((reason) => {
+          console.log(reason);
+          return null;
+        });
+        if (!index_data) {
+          index_data = KBSRevisionIndex.dataFromCSV(await this.getCSV());
+        }
+        this.index = new KBSRevisionIndex(this, index_data);
+        return this.index;
+      })();
+    }
+    return this._index_promise;
+  }
+
   async getRevisions() {
     if (!this.revisions) {
-      this.csv_data = (await this.getCSV()).split("\n");
-      this.revisions = this.csv_data
-        .filter((x) => x !== "")
-        .map((x) => {
-          return new KBSRevision(this).loadFromCSV(x);
-        });
+      let index = await this.getIndex();
+      this.revisions = index.rows.map((_, row_id) =>
+        index.getRevision(row_id),
+      );
     }
     return this.revisions;
   }
 
+  // Takes a full or abbreviated SHA, null if it matches no revision or several
   async getRevisionBySha(git_sha) {
-    for (let rev of await this.getRevisions()) {
-      if (rev.git_sha === git_sha) {
-        return rev;
+    let matches = (await this.getIndex()).findBySha(git_sha);
+    return matches.length === 1 ? matches[0] : null;
+  }
+
+  async getRevisionByVer(query) {
+    return (await this.getIndex()).findByVersion(query);
+  }
+}
+
+/* The layout written by revdb/bin/make-index:
+ * bundles - [kconfig_hash, bundle variants] for each distinct bundle
+ * rows - [git_sha, human_version, bundle id], in CSV order
+ * by_sha - row ids, ordered by SHA
+ * by_version - human_version to row id
+ */
+class KBSRevisionIndex {
+  constructor(project, index_data) {
+    this.project = project;
+    this.bundles = index_data.bundles;
+    this.rows = index_data.rows;
+    this.by_sha = index_data.by_sha;
+    this.by_version = new Map(Object.entries(index_data.by_version));
+    this._revisions = new Array(this.rows.length);
+  }
+
+  static dataFromCSV(csv_text) {
+    let index_data = { bundles: [], rows: [], by_version: {} };
+    let bundle_ids = new Map();
+    for (let csv_line of csv_text.split("\n")) {
+      if (csv_line === "") {
+        continue;
+      }
+      let csv_fields = csv_line.split(",");
+      let bundle_key = csv_fields[2] + "," + (csv_fields[3] || "tar");
+      if (!bundle_ids.has(bundle_key)) {
+        bundle_ids.set(bundle_key, index_data.bundles.length);
+        index_data.bundles.push([csv_fields[2], csv_fields[3] || "tar"]);
+      }
+      if (!index_data.by_version.hasOwnProperty(csv_fields[1])) {
+        index_data.by_version[csv_fields[1]] = index_data.rows.length;
       }
+      index_data.rows.push([
+        csv_fields[0],
+        csv_fields[1],
+        bundle_ids.get(bundle_key),
+      ]);
     }
-    return null;
+    index_data.by_sha = index_data.rows
+      .map((_, row_id) => row_id)
+      .sort((a, b) =>
+        index_data.rows[a][0] < index_data.rows[b][0] ? -1 : 1,
+      );
+    return index_data;
   }
 
-  async getRevisionByVer(query) {
-    for (let rev of await this.getRevisions()) {
-      if (rev.human_version === query) {
-        return rev;
+  getRevision(row_id) {
+    if (!this._revisions[row_id]) {
+      let row = this.rows[row_id];
+      let bundle = this.bundles[row[2]];
+      this._revisions[row_id] = new KBSRevision(this.project).load(
+        row[0],
+        row[1],
+        bundle[0],
+        bundle[1],
+      );
+    }
+    return this._revisions[row_id];
+  }
+
+  // The first position in by_sha whose SHA sorts at or after sha_prefix
+  _shaLowerBound(sha_prefix) {
+    let low = 0;
+    let high = this.by_sha.length;
+    while (low < high) {
+      let mid = (low + high) >>> 1;
+      if (this.rows[this.by_sha[mid]][0] < sha_prefix) {
+        low = mid + 1;
+      } else {
+        high = mid;
       }
     }
-    return null;
+    return low;
+  }
+
+  findBySha(sha_prefix) {
+    sha_prefix = sha_prefix.toLowerCase();
+    let matches = [];
+    for (
+      let pos = this._shaLowerBound(sha_prefix);
+      pos < this.by_sha.length &&
+      this.rows[this.by_sha[pos]][0].startsWith(sha_prefix);
+      pos++
+    ) {
+      matches.push(this.getRevision(this.by_sha[pos]));
+    }
+    return matches;
+  }
+
+  findByVersion(human_version) {
+    let row_id = this.by_version.get(human_version);
+    return row_id === undefined ? null : this.getRevision(row_id);
   }
 }
 
@@ -73,14 +190,28 @@ class KBSRevision {
     this.git_sha = undefined;
     this.human_version = undefined;
     this.kconfig_hash = undefined;
+    this.bundle_suffixes = ["tar"];
+  }
+
+  load(git_sha, human_version, kconfig_hash, bundle_variants) {
+    this.git_sha = git_sha;
+    this.human_version = human_version;
+    this.kconfig_hash = kconfig_hash;
+    // Bundle variants, best first. Older CSVs only have the plain tar
+    if (bundle_variants) {
+      this.bundle_suffixes = bundle_variants.split(";");
+    }
+    return this;
   }
 
   loadFromCSV(csv_line) {
     let csv_fields = csv_line.split(",");
-    this.git_sha = csv_fields[0];
-    this.human_version = csv_fields[1];
-    this.kconfig_hash = csv_fields[2];
-    return this;
+    return this.load(
+      csv_fields[0],
+      csv_fields[1],
+      csv_fields[2],
+      csv_fields[3],
+    );
   }
 
   getKConfigBundleUrl() {
@@ -90,7 +221,8 @@ class KBSRevision {
         this.project.project_name +
         "/kconfig-" +
         this.kconfig_hash +
-        ".tar",
+        "." +
+        this.bundle_suffixes[0],
       window.location,
     );
   }